@@ -0,0 +1,83 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException
+from passlib.hash import bcrypt
+
+from shared.tracing import span
+
+# bcrypt cost factor for new hashes, existing hashes with another cost are rehashed on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+# Hashing runs in its own processes so it never blocks the event loop or the GIL,
+# at most HASH_QUEUE_SIZE calls wait for a free worker, the rest is turned away with a 503
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_QUEUE_SIZE = int(os.getenv("HASH_QUEUE_SIZE", str(HASH_WORKERS * 4)))
+HASH_RETRY_AFTER = int(os.getenv("HASH_RETRY_AFTER", "1"))
+
+hasher = bcrypt.using(rounds=BCRYPT_ROUNDS)
+
+hash_pool = None
+inflight = 0
+
+
+def _hash(password: str) -> str:
+    return hasher.hash(password)
+
+
+def _verify(password: str, hashed: str):
+    """Returns (valid, new hash or None), the new hash is only computed when the stored cost is outdated."""
+    if not hasher.verify(password, hashed):
+        return False, None
+
+    if hasher.needs_update(hashed):
+        return True, hasher.hash(password)
+
+    return True, None
+
+
+async def _submit(fn, *args):
+    global hash_pool, inflight
+
+    # Only touched from the event loop, no lock needed
+    if inflight >= HASH_WORKERS + HASH_QUEUE_SIZE:
+        raise HTTPException(status_code=503,
+                            detail="Too many authentication requests, retry later",
+                            headers={"Retry-After": str(HASH_RETRY_AFTER)})
+
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+
+    inflight += 1
+
+    try:
+        # Includes the wait for a free worker
+        with span(f"bcrypt.{fn.__name__.lstrip('_')}", attributes={"bcrypt.rounds": BCRYPT_ROUNDS, "hash.inflight": inflight}):
+            return await asyncio.get_running_loop().run_in_executor(hash_pool, fn, *args)
+    finally:
+        inflight -= 1
+
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+
+async def verify_password(password: str, hashed: str):
+    return await _submit(_verify, password, hashed)
+
+
+async def warm_up_hash_pool():
+    """Starts every worker process with one hash each, the first logins don't pay for the spawn and the bcrypt backend load."""
+    global hash_pool
+
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+
+    # Submitted together so no worker is idle when the next one is asked for, the pool starts all of them
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(hash_pool, _hash, "warm-up") for _ in range(HASH_WORKERS)))
+
+
+def shutdown():
+    if hash_pool is not None:
+        hash_pool.shutdown(cancel_futures=True)
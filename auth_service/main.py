@@ -1,32 +1,36 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import jwt
-from passlib.hash import bcrypt
 from datetime import datetime, timedelta, timezone
 from shared.models import User
-from shared.database import SessionLocal
+from shared.database import AsyncSessionLocal, QueryProfilerMiddleware, check_schema, warm_up_pool
+from shared.health import add_health_endpoints
+from shared.metrics import MetricsMiddleware
 from shared.schemas import UserCreate, Token
+from shared.tracing import TracingMiddleware, setup_tracing
 import os
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from starlette.responses import Response
-from time import time
+from hashing import hash_password, verify_password, warm_up_hash_pool, shutdown as shutdown_hash_pool
 
 
+setup_tracing("auth_service")
+
 app = FastAPI()
 
-# Prometheus metrics
-REQUEST_COUNT = Counter(
-    'auth_service_requests_total',
-    'Total number of requests',
-    ['method', 'endpoint', 'status']
-)
+# Prometheus metrics, labelled by route template
+app.add_middleware(MetricsMiddleware, service="auth_service")
+
+# Statements and database time per request, only with DB_PROFILING=true
+app.add_middleware(QueryProfilerMiddleware)
 
-REQUEST_LATENCY = Histogram(
-    'auth_service_request_latency_seconds',
-    'Request latency in seconds',
-    ['method', 'endpoint']
-)
+# Server span per request continuing Kong's trace, outermost so it covers the other middlewares
+app.add_middleware(TracingMiddleware)
+
+# /healthz, and /readyz once the connections are open and the hashing workers are up
+add_health_endpoints(app, "auth", warm_up_pool, warm_up_hash_pool, requires=[check_schema])
 
 # JWT config
 SECRET_KEY = os.getenv("JWT_SECRET")
@@ -35,13 +39,14 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 
 # Dependency to get DB session
-def get_main_db():
-    db = SessionLocal()
-
-    try:
+async def get_main_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+
+@app.on_event("shutdown")
+def stop_hash_pool():
+    shutdown_hash_pool()
 
 
 # JWT Helper
@@ -56,25 +61,6 @@ def create_access_token(username: str):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-# Middleware to track metrics
-@app.middleware("http")
-async def track_metrics(request, call_next):
-    start_time = time()
-    method = request.method
-    endpoint = request.url.path
-
-    try:
-        response = await call_next(request)
-        status_code = response.status_code
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status_code).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time() - start_time)
-        return response
-    except Exception as e:
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=500).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time() - start_time)
-        raise e
-
-
 # Metrics endpoint
 @app.get("/metrics")
 async def metrics():
@@ -83,25 +69,25 @@ async def metrics():
 
 # Routes
 @app.post("/register")
-def register(user: UserCreate,
-             db: Session = Depends(get_main_db)):
+async def register(user: UserCreate,
+                   db: AsyncSession = Depends(get_main_db)):
     
-    existing_user = db.query(User).filter(User.username == user.username).first()
+    existing_user = await db.scalar(select(User).where(User.username == user.username))
 
     if existing_user:
         raise HTTPException(status_code=400, detail=f"Username {existing_user.username} already exists")
 
-    hashed_pw = bcrypt.hash(user.password)
+    hashed_pw = await hash_password(user.password)
     new_user = User(username=user.username, password=hashed_pw)
 
     try:
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
 
     except Exception as e:
         print(f"[auth/register] Commit failed: {e}")
-        db.rollback()
+        await db.rollback()
 
         raise HTTPException(status_code=500, detail="Database error")
 
@@ -109,13 +95,28 @@ def register(user: UserCreate,
 
 
 @app.post("/login", response_model=Token)
-def login(user: UserCreate,
-          db: Session = Depends(get_main_db)):
+async def login(user: UserCreate,
+                db: AsyncSession = Depends(get_main_db)):
     
-    db_user = db.query(User).filter(User.username == user.username).first()
+    db_user = await db.scalar(select(User).where(User.username == user.username))
 
-    if not db_user or not bcrypt.verify(user.password, db_user.password):
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    valid, new_hash = await verify_password(user.password, db_user.password)
+
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    # BCRYPT_ROUNDS changed since this hash was made, store one with the current cost
+    if new_hash:
+        db_user.password = new_hash
+
+        try:
+            await db.commit()
+        except Exception as e:
+            print(f"[auth/login] Rehash commit failed: {e}")
+            await db.rollback()
 
     access_token = create_access_token(user.username)
 
@@ -0,0 +1,139 @@
+"""
+Per-request overhead of the HTTP metrics middleware.
+
+The same small FastAPI app (a static route and a route with a path parameter)
+is called directly through ASGI, no server or network involved, with:
+  none    - no middleware, the baseline
+  legacy  - the @app.middleware("http") track_metrics the services had, labelled by request.url.path
+  shared  - shared.metrics.MetricsMiddleware, labelled by route template
+
+The overhead is the difference to the baseline in microseconds per request.
+The number of series each variant creates for --ids distinct trade ids is printed as well.
+
+    python benchmarks/metrics_middleware_bench.py --requests 20000 --ids 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi import FastAPI
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY
+
+from shared.metrics import MetricsMiddleware
+
+
+def base_app():
+    app = FastAPI()
+
+    @app.get("/get_balance")
+    async def get_balance():
+        return {"balance": 100.0}
+
+    @app.put("/edit_trade/{trade_id}")
+    async def edit_trade(trade_id: int):
+        return {"msg": "Trade updated successfully", "trade_id": trade_id}
+
+    return app
+
+
+def legacy_app():
+    app = base_app()
+
+    # Copied from the services before shared.metrics, in a registry of its own
+    registry = CollectorRegistry()
+    request_count = Counter('legacy_requests_total', 'Total number of requests',
+                            ['method', 'endpoint', 'status'], registry=registry)
+    request_latency = Histogram('legacy_request_latency_seconds', 'Request latency in seconds',
+                                ['method', 'endpoint'], registry=registry)
+
+    @app.middleware("http")
+    async def track_metrics(request, call_next):
+        start_time = time.time()
+        method = request.method
+        endpoint = request.url.path
+
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            request_count.labels(method=method, endpoint=endpoint, status=status_code).inc()
+            request_latency.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            return response
+        except Exception as e:
+            request_count.labels(method=method, endpoint=endpoint, status=500).inc()
+            request_latency.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
+            raise e
+
+    return app, registry
+
+
+def shared_app():
+    app = base_app()
+    app.add_middleware(MetricsMiddleware, service="bench")
+    return app
+
+
+def series(registry, prefix):
+    return sum(len(metric.samples) for metric in registry.collect() if metric.name.startswith(prefix))
+
+
+async def call(app, method, path):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": b"", "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 1), "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def run(app, requests, ids):
+    # Warm up: routes compiled, label children created
+    for i in range(ids):
+        await call(app, "PUT", f"/edit_trade/{i}")
+
+    start = time.perf_counter()
+
+    for i in range(requests):
+        if i % 2:
+            await call(app, "GET", "/get_balance")
+        else:
+            await call(app, "PUT", f"/edit_trade/{i % ids}")
+
+    return (time.perf_counter() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--ids", type=int, default=1000, help="distinct trade ids in the /edit_trade/{id} requests")
+    parser.add_argument("--rounds", type=int, default=3, help="best of this many runs")
+    args = parser.parse_args()
+
+    legacy, legacy_registry = legacy_app()
+    apps = {"none": base_app(), "legacy": legacy, "shared": shared_app()}
+
+    results = {name: min(asyncio.run(run(app, args.requests, args.ids)) for _ in range(args.rounds))
+               for name, app in apps.items()}
+
+    print(f"requests={args.requests} distinct ids={args.ids}")
+
+    for name, micros in results.items():
+        overhead = micros - results["none"]
+        print(f"{name:<8}{micros:10.1f} us/request{overhead:+10.1f} us overhead")
+
+    print(f"series  legacy {series(legacy_registry, 'legacy_')}, shared {series(REGISTRY, 'bench_')}")
+
+
+if __name__ == "__main__":
+    main()
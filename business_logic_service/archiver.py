@@ -0,0 +1,77 @@
+import os
+import time
+from sqlalchemy import text
+
+from shared.database import SessionLocal, engine as db_engine, profile_unit
+from shared.tracing import setup_tracing, span
+
+# Executed orders are moved from trades to trades_history so the hot table only keeps
+# (about) the open orders. Every replica may run it, rows are claimed with SKIP LOCKED
+ARCHIVER_ENABLED = os.getenv("ARCHIVER_ENABLED", "true").lower() == "true"
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "60")) # seconds
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+
+# Deleted from trades and inserted into trades_history by one statement, a row is always in exactly one of them.
+# The batch is collected into an array first (an InitPlan) and deleted through the primary key, with
+# IN (SELECT ...) Postgres hash joins the batch against a sequential scan of trades
+ARCHIVE_BATCH = text("""
+    WITH moved AS (
+        DELETE FROM trades
+        WHERE id = ANY(ARRAY(
+            SELECT id FROM trades
+            WHERE flag <> 'unprocessed'
+            ORDER BY id
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        ))
+        RETURNING id, username, symbol, quantity, price, action, created_at, flag, portfolio_price
+    )
+    INSERT INTO trades_history (id, username, symbol, quantity, price, action, created_at, flag, portfolio_price)
+    SELECT id, username, symbol, quantity, price, action, created_at, flag, portfolio_price FROM moved
+""")
+
+
+@profile_unit("archive_batch")
+def archive_batch() -> int:
+    db = SessionLocal()
+
+    with span("archive_batch", attributes={"archive.batch_size": ARCHIVE_BATCH_SIZE}):
+        try:
+            moved = db.execute(ARCHIVE_BATCH, {"batch_size": ARCHIVE_BATCH_SIZE}).rowcount
+            db.commit()
+            return moved
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+def archive() -> int:
+    # Short transactions one batch at a time, the matcher and the API keep going in between
+    total = 0
+
+    while True:
+        moved = archive_batch()
+        total += moved
+
+        if moved < ARCHIVE_BATCH_SIZE:
+            return total
+
+
+def run_archiver():
+    # Connections inherited from the parent process must not be shared
+    db_engine.dispose(close=False)
+    setup_tracing("business_logic_service")
+
+    while True:
+        try:
+            moved = archive()
+
+            if moved:
+                print(f"[business_logic/archiver] Moved {moved} executed trades to trades_history")
+
+        except Exception as e:
+            print(f"[business_logic/archiver] Error: {e}")
+
+        time.sleep(ARCHIVE_INTERVAL)
@@ -0,0 +1,117 @@
+import argparse
+from datetime import datetime
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+# Each interval is rolled up from the one before it, 1m from the fills themselves
+CANDLE_INTERVALS = [
+    ("1m", "1 minute", None),
+    ("5m", "5 minutes", "1m"),
+    ("1h", "1 hour", "5m"),
+    ("1d", "1 day", "1h"),
+]
+
+# Buckets are aligned to UTC, a day starts at midnight
+ORIGIN = "TIMESTAMPTZ '2000-01-01 00:00:00+00'"
+
+FILLS_SOURCE = """
+    SELECT symbol, executed_at AS ts, id AS seq, price AS open, price AS high, price AS low, price AS close,
+           quantity AS volume, 1 AS trade_count
+    FROM fills
+"""
+
+CANDLES_SOURCE = """
+    SELECT symbol, bucket_start AS ts, 0 AS seq, open, high, low, close, volume, trade_count
+    FROM candles
+    WHERE interval = :source_interval
+"""
+
+
+def rollup_statement(source: str):
+    # The buckets of [start, end] are recomputed from their source rows, whatever was stored before:
+    # running it twice, or again after a late fill, gives the same candles
+    return text(f"""
+        WITH bounds AS (
+            SELECT date_bin(CAST(:step AS INTERVAL), COALESCE(CAST(:start AS TIMESTAMPTZ), now()), {ORIGIN}) AS range_start,
+                   date_bin(CAST(:step AS INTERVAL), COALESCE(CAST(:end AS TIMESTAMPTZ), now()), {ORIGIN})
+                   + CAST(:step AS INTERVAL) AS range_end
+        ),
+        bars AS (
+            SELECT s.symbol,
+                   date_bin(CAST(:step AS INTERVAL), s.ts, {ORIGIN}) AS bucket_start,
+                   (array_agg(s.open ORDER BY s.ts, s.seq))[1] AS open,
+                   max(s.high) AS high,
+                   min(s.low) AS low,
+                   (array_agg(s.close ORDER BY s.ts DESC, s.seq DESC))[1] AS close,
+                   sum(s.volume) AS volume,
+                   sum(s.trade_count) AS trade_count
+            FROM ({source}) AS s, bounds
+            WHERE s.symbol = ANY(CAST(:symbols AS TEXT[]))
+              AND s.ts >= bounds.range_start AND s.ts < bounds.range_end
+            GROUP BY s.symbol, 2
+        ),
+        emptied AS (
+            -- Buckets left without any source row (e.g. fills that were corrected away)
+            DELETE FROM candles USING bounds
+            WHERE candles.symbol = ANY(CAST(:symbols AS TEXT[]))
+              AND candles.interval = :interval
+              AND candles.bucket_start >= bounds.range_start AND candles.bucket_start < bounds.range_end
+              AND NOT EXISTS (SELECT 1 FROM bars WHERE bars.symbol = candles.symbol AND bars.bucket_start = candles.bucket_start)
+        )
+        INSERT INTO candles (symbol, interval, bucket_start, open, high, low, close, volume, trade_count)
+        SELECT symbol, :interval, bucket_start, open, high, low, close, volume, trade_count FROM bars
+        ON CONFLICT (symbol, interval, bucket_start) DO UPDATE
+        SET open = EXCLUDED.open, high = EXCLUDED.high, low = EXCLUDED.low, close = EXCLUDED.close,
+            volume = EXCLUDED.volume, trade_count = EXCLUDED.trade_count, updated_at = now()
+        WHERE (candles.open, candles.high, candles.low, candles.close, candles.volume, candles.trade_count)
+              IS DISTINCT FROM (EXCLUDED.open, EXCLUDED.high, EXCLUDED.low, EXCLUDED.close, EXCLUDED.volume, EXCLUDED.trade_count)
+    """)
+
+
+FILLS_ROLLUP = rollup_statement(FILLS_SOURCE)
+CANDLES_ROLLUP = rollup_statement(CANDLES_SOURCE)
+
+
+def refresh_candles(db: Session, symbols, start: datetime = None, end: datetime = None):
+    """
+    Recomputes the candles of every interval covering [start, end] for the symbols,
+    by default the buckets of the current transaction's time (what settlement just filled).
+    Doesn't commit.
+    """
+    symbols = sorted(set(symbols))
+
+    if not symbols:
+        return
+
+    for interval, step, source_interval in CANDLE_INTERVALS:
+        params = {"symbols": symbols, "interval": interval, "step": step, "start": start, "end": end}
+
+        if source_interval is None:
+            db.execute(FILLS_ROLLUP, params)
+        else:
+            db.execute(CANDLES_ROLLUP, {**params, "source_interval": source_interval})
+
+
+def main():
+    # Rebuilds the candles of a time range after the fills were corrected by hand
+    parser = argparse.ArgumentParser(description="Recompute the OHLCV candles of a time range from the fills")
+    parser.add_argument("symbols", nargs="+")
+    parser.add_argument("--start", type=datetime.fromisoformat, required=True)
+    parser.add_argument("--end", type=datetime.fromisoformat, default=None)
+    args = parser.parse_args()
+
+    from shared.database import SessionLocal
+    from shared.schemas import normalize_symbol
+
+    db = SessionLocal()
+
+    try:
+        refresh_candles(db, [normalize_symbol(symbol) for symbol in args.symbols], args.start, args.end or datetime.now().astimezone())
+        db.commit()
+        print(f"[business_logic/candles] Rebuilt candles of {', '.join(args.symbols)} since {args.start.isoformat()}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
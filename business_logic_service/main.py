@@ -1,137 +1,148 @@
+import multiprocessing
+import os
 import time
 from sqlalchemy.orm import Session
-from shared.database import SessionLocal
-from shared.models import User, Portfolio, Trade
-from decimal import Decimal
+from shared.database import SessionLocal, engine as db_engine, profile_unit, wait_for_schema
+from shared.events import ORDER_EVENTS_CHANNEL, SHARD_REBALANCE_CHANNEL, parse_order_events, transport
+from shared.tracing import context_from_traceparent, links_to, mark_error, setup_tracing, span
+from archiver import ARCHIVER_ENABLED, run_archiver
+from matching_engine import MatchingEngine
+from metrics import MATCH_ERRORS, MATCH_PHASE_LATENCY, mark_process_dead, start_metrics_server
+from sharding import MATCHER_WORKERS, ShardLostError, ShardOwner
 
-SLEEP_TIME = 3 # seconds
+# Orders are matched as soon as their event arrives, the periodic full reload
+# only catches events that were missed (e.g. while the listener was reconnecting)
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "30")) # seconds
+RECONNECT_DELAY = 3 # seconds
 
-def match_trades():
-    main_db: Session = SessionLocal()
 
-    try:
+def match_span(events):
+    """The cycle continues the trace of the request behind its event, with several it links to all of them."""
+    traceparents = {event.traceparent for event in events or () if event.traceparent}
+    parent = context_from_traceparent(next(iter(traceparents))) if len(traceparents) == 1 else None
+    links = links_to(traceparents) if len(traceparents) > 1 else None
 
-        # Get all buy orders sorted by highest price and earliest time
-        buy_orders = main_db.query(Trade).filter(
-            Trade.flag == "unprocessed",
-            Trade.action == "buy"
-        ).order_by(Trade.price.desc(), Trade.created_at.asc()).all()
+    return span("match_trades", kind="consumer", parent=parent, links=links,
+                attributes={"match.events": len(events) if events is not None else 0,
+                            "match.full_load": events is None})
 
-        for buy in buy_orders:
 
-            sell_orders = main_db.query(Trade).filter(
-                Trade.flag == "unprocessed",
-                Trade.action == "sell",
-                Trade.symbol == buy.symbol,
-                Trade.price <= buy.price
-            ).order_by(Trade.created_at.asc()).all()
-            
+@profile_unit("match_trades")
+def match_trades(engine: MatchingEngine, events=None):
+    main_db: Session = SessionLocal()
+    phase = "load"
 
-            for sell in sell_orders:
-                if buy.quantity == 0:
-                    break  # This buy order has been filled
+    with match_span(events):
+        try:
+            started = time.perf_counter()
 
-                matched_qty = min(buy.quantity, sell.quantity)
+            with span("matcher.load"):
+                if events is None:
+                    engine.load(main_db)
+                else:
+                    engine.apply_events(main_db, events)
 
-                if matched_qty <= 0:
-                    continue
+                # End the read transaction before matching, settlement opens its own
+                main_db.commit()
 
-                
-                match_price = sell.price
-                total = Decimal(str(matched_qty)) * Decimal(str(match_price))
-                
+            MATCH_PHASE_LATENCY.labels(phase="load").observe(time.perf_counter() - started)
 
-                # Update seller's balance
-                seller = main_db.query(User).filter(User.username == sell.username).first()
-                
-                if not seller:
-                    raise Exception(f"[business_logic] Seller {sell.username} not found")
-                
-                seller.balance += total
+            phase = "settle"
+            engine.match(main_db)
+            engine.report_open_orders()
 
+        except ShardLostError:
+            raise
 
-                # Credit the buyer's balance with the difference between the sell price and his asking price
-                buyer = main_db.query(User).filter(User.username == buy.username).first()
+        except Exception as e:
+            print(f"[business_logic] Error in trade matching: {e}")
+            MATCH_ERRORS.labels(phase=phase).inc()
+            mark_error(e)
+            main_db.rollback()
+        finally:
+            main_db.close()
 
-                if not buyer:
-                    raise Exception(f"[business_logic] Buyer {buy.username} not found")
-                
-                original_total = Decimal(str(matched_qty)) * Decimal(str(buy.price))
-                refund = original_total - total
 
-                if refund > 0:
-                    buyer.balance += refund
+def run(engine: MatchingEngine, shards: ShardOwner):
+    listener = transport.listen(ORDER_EVENTS_CHANNEL, SHARD_REBALANCE_CHANNEL)
 
+    try:
+        shards.claim()
+        print(f"[business_logic] Worker {os.getpid()} owns shards {sorted(shards.owned)}")
 
-                # Update buyer's portfolio
-                buyer_holding = main_db.query(Portfolio).filter_by(
-                    username=buy.username,
-                    symbol=buy.symbol
-                ).first()
+        # Listen before loading so no order falls between the load and the first event
+        match_trades(engine)
+        started = time.monotonic()
+        next_reconcile = started + RECONCILE_INTERVAL
 
-                if buyer_holding:
-                    total_shares = buyer_holding.quantity + matched_qty
+        while True:
+            messages = listener.wait(max(0, next_reconcile - time.monotonic()))
+            events = parse_order_events(messages)
 
-                    # Recalculate the average price
-                    try:
-                        new_price = (Decimal(str(buyer_holding.price)) * Decimal(str(buyer_holding.quantity)) + total) \
-                            / Decimal(str(total_shares))
+            # Another worker gave shards back, the ones taken here come with a full load,
+            # which also covers the order events received along
+            if any(channel == SHARD_REBALANCE_CHANNEL for channel, payload in messages) and shards.claim():
+                print(f"[business_logic] Worker {os.getpid()} claimed released shards, now owns {sorted(shards.owned)}")
+                match_trades(engine)
 
-                        buyer_holding.price = new_price
+            elif events:
+                match_trades(engine, events)
 
-                    except Exception as e:
-                        print(f"[business_logic] Error calculating new price: {e}")
-                        continue
+            if time.monotonic() >= next_reconcile:
+                # Between match cycles no settlement is in flight, the full load below
+                # drops the books of released shards and loads the ones acquired
+                released = shards.rebalance()
+                acquired = shards.claim()
 
+                if released or acquired:
+                    print(f"[business_logic] Worker {os.getpid()} released shards {sorted(released)}, "
+                          f"acquired {sorted(acquired)}, now owns {sorted(shards.owned)}")
 
-                    buyer_holding.quantity = total_shares
+                match_trades(engine)
+                next_reconcile = time.monotonic() + RECONCILE_INTERVAL
 
-                    try:
-                        main_db.commit()
-                    except Exception as e:
-                        print(f"[business_logic] Commit failed: {e}")
-                        main_db.rollback()
-    
-                else:
+    finally:
+        listener.close()
 
-                    # Create a new portfolio entry for the buyer
-                    buyer_holding = Portfolio(
-                        username=buy.username,
-                        symbol=buy.symbol,
-                        quantity=matched_qty,
-                        price=Decimal(str(match_price))
-                    )
-                    
-                    # Add the new holding to the database
-                    try:
-                        main_db.add(buyer_holding)
-                        main_db.commit()
-                    except Exception as e:
-                        print(f"[business_logic] Commit failed: {e}")
-                        main_db.rollback()
-
-                    main_db.refresh(buyer_holding)
-
-                # Update trades
-                buy.quantity -= matched_qty
-                sell.quantity -= matched_qty
-
-                if buy.quantity == 0:
-                    buy.flag = "executed"
-
-                if sell.quantity == 0:
-                    sell.flag = "executed"
-
-                # Commit changes
-                main_db.commit()
 
-    except Exception as e:
-        print(f"[business_logic] Error in trade matching: {e}")
-    finally:
-        main_db.close()
-    
+def worker():
+    # Connections inherited from the parent process must not be shared
+    db_engine.dispose(close=False)
+    # Per process, the span exporter's thread doesn't survive the fork
+    setup_tracing("business_logic_service")
 
-if __name__ == "__main__":
     while True:
-        match_trades()
-        time.sleep(SLEEP_TIME)
\ No newline at end of file
+        shards = None
+
+        try:
+            shards = ShardOwner()
+            run(MatchingEngine(shards), shards)
+        except Exception as e:
+            print(f"[business_logic] Worker {os.getpid()} failed, restarting: {e}")
+            time.sleep(RECONNECT_DELAY)
+        finally:
+            if shards:
+                shards.close()
+
+
+if __name__ == "__main__":
+    start_metrics_server()
+    # Swarm starts the matcher alongside the migrations, nothing runs against an old schema
+    wait_for_schema("business_logic")
+    # The parent keeps no connection, the forked processes open their own
+    db_engine.dispose()
+
+    if ARCHIVER_ENABLED:
+        multiprocessing.Process(target=run_archiver, daemon=True).start()
+
+    if MATCHER_WORKERS == 1:
+        worker()
+    else:
+        processes = [multiprocessing.Process(target=worker, daemon=True) for _ in range(MATCHER_WORKERS)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+            mark_process_dead(process.pid)
@@ -0,0 +1,158 @@
+import time
+from decimal import Decimal
+from sqlalchemy.orm import Session
+
+from shared.models import Trade
+from shared.tracing import links_to, mark_error, span
+from order_book import Order, OrderBook
+from metrics import FILLS_PER_CYCLE, MATCH_ERRORS, MATCH_PHASE_LATENCY, STALE_SETTLEMENTS, report_open_orders
+from settlement import SettlementBatch
+from sharding import ShardLostError
+
+# Rounds of one match() call: books reloaded after a stale or failed settlement are matched
+# again right away, a symbol still changing after that waits for its next event or the reconcile
+MAX_MATCH_ROUNDS = 3
+
+
+class MatchingEngine:
+    """
+    Keeps one in-memory OrderBook per symbol.
+
+    The books are loaded once from the trades table and then fed incrementally
+    from order events: only the orders named in an event are re-read, and only
+    the books that received new orders are matched. With a ShardOwner only the
+    symbols in the owned shards are kept.
+    """
+
+    def __init__(self, shards=None):
+        self.books = {}
+        self.dirty = set()
+        self.shards = shards
+        # Symbols whose open orders gauge is out of date, None after a full load
+        self.touched = None
+
+    def owns(self, symbol):
+        return self.shards is None or self.shards.owns(symbol)
+
+    def book(self, symbol):
+        if self.touched is not None:
+            self.touched.add(symbol)
+
+        if symbol not in self.books:
+            self.books[symbol] = OrderBook(symbol)
+
+        return self.books[symbol]
+
+    def load(self, db: Session):
+        self.books = {}
+        self.dirty = set()
+        self.touched = None
+
+        for trade in db.query(Trade).filter(Trade.flag == "unprocessed"):
+            if self.owns(trade.symbol):
+                self.apply(trade)
+
+    def load_symbol(self, db: Session, symbol):
+        self.books.pop(symbol, None)
+
+        if self.touched is not None:
+            self.touched.add(symbol)
+
+        for trade in db.query(Trade).filter(Trade.flag == "unprocessed", Trade.symbol == symbol):
+            self.apply(trade)
+
+    def apply_events(self, db: Session, events):
+        symbols = {event.trade_id: event.symbol for event in events if self.owns(event.symbol)}
+        traceparents = {event.trade_id: event.traceparent for event in events}
+
+        if not symbols:
+            return
+
+        found = set()
+
+        # Re-read the current state of every order an event was published for
+        for trade in db.query(Trade).filter(Trade.id.in_(symbols.keys())):
+            found.add(trade.id)
+
+            if trade.flag == "unprocessed":
+                self.apply(trade, traceparents.get(trade.id))
+            else:
+                self.book(trade.symbol).remove(trade.id)
+
+        # Deleted orders
+        for trade_id, symbol in symbols.items():
+            if trade_id not in found:
+                self.book(symbol).remove(trade_id)
+
+    def apply(self, trade, traceparent=None):
+        book = self.book(trade.symbol)
+        current = book.orders.get(trade.id)
+
+        # Already known and unchanged
+        if current and current.created_at == trade.created_at \
+                and current.quantity == trade.quantity \
+                and current.price == Decimal(str(trade.price)):
+            return
+
+        book.remove(trade.id)
+
+        if trade.quantity > 0:
+            book.add(Order.from_trade(trade, traceparent))
+            self.dirty.add(trade.symbol)
+
+    def report_open_orders(self):
+        report_open_orders(self.books, self.touched)
+        self.touched = set()
+
+    def match(self, db: Session):
+        filled = 0
+
+        for _ in range(MAX_MATCH_ROUNDS):
+            if not self.dirty:
+                break
+
+            filled += self._match_round(db)
+
+        return filled
+
+    def _match_round(self, db: Session):
+        dirty, self.dirty = self.dirty, set()
+        batch = SettlementBatch()
+        started = time.perf_counter()
+
+        with span("matcher.match", attributes={"match.symbols": len(dirty)}):
+            for symbol in sorted(dirty):
+                batch.add(symbol, self.books[symbol].match())
+
+        MATCH_PHASE_LATENCY.labels(phase="match").observe(time.perf_counter() - started)
+
+        if not batch:
+            FILLS_PER_CYCLE.observe(0)
+            return 0
+
+        # Linked to the traces of every order filled, the resting ones were placed by other requests
+        with span("matcher.settle", attributes={"match.fills": len(batch)}, links=links_to(batch.traceparents())):
+            try:
+                stale = batch.settle(db, self.shards)
+
+            except ShardLostError:
+                db.rollback()
+                raise
+
+            except Exception as e:
+                # The books already consumed the fills, bring them back in line with the database
+                print(f"[business_logic] Settlement failed, reloading {sorted(batch.symbols())}: {e}")
+                MATCH_ERRORS.labels(phase=batch.phase).inc()
+                mark_error(e)
+                db.rollback()
+                stale = batch.symbols()
+                batch = SettlementBatch()
+
+        for symbol in stale:
+            print(f"[business_logic] Orders for {symbol} changed during matching, reloading book")
+            STALE_SETTLEMENTS.inc()
+            self.load_symbol(db, symbol)
+
+        FILLS_PER_CYCLE.observe(len(batch))
+
+        return len(batch)
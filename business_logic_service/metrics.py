@@ -0,0 +1,99 @@
+import os
+import shutil
+from datetime import datetime, timezone
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, multiprocess, start_http_server
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8005"))
+
+# The matcher workers are separate processes, with PROMETHEUS_MULTIPROC_DIR set they write their
+# samples there and the parent's /metrics aggregates them. Emptied here, before any metric exists,
+# only the parent imports this module, the workers are forked from it
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+if MULTIPROC_DIR:
+    shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+MATCH_PHASE_LATENCY = Histogram(
+    'business_logic_service_match_phase_seconds',
+    'Duration of a match cycle phase in seconds (load, match, settle, commit)',
+    ['phase']
+)
+
+MATCH_ERRORS = Counter(
+    'business_logic_service_match_errors_total',
+    'Failed match cycles by phase (load, settle, commit)',
+    ['phase']
+)
+
+STALE_SETTLEMENTS = Counter(
+    'business_logic_service_stale_settlements_total',
+    'Symbols whose fills were dropped because an order changed during matching'
+)
+
+FILLS_PER_CYCLE = Histogram(
+    'business_logic_service_fills_per_cycle',
+    'Fills settled per match cycle',
+    buckets=(0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+)
+
+ORDER_TO_FILL_LATENCY = Histogram(
+    'business_logic_service_order_to_fill_seconds',
+    'Time from the order\'s created_at to the commit of its fill in seconds',
+    ['side'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400)
+)
+
+OPEN_ORDERS = Gauge(
+    'business_logic_service_open_orders',
+    'Open orders in the in-memory books by symbol and side',
+    ['symbol', 'side'],
+    multiprocess_mode='livesum'
+)
+
+# Symbols this process has a non-zero open orders gauge for
+reported_symbols = set()
+
+
+def start_metrics_server():
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(METRICS_PORT, registry=registry)
+    else:
+        start_http_server(METRICS_PORT)
+
+    print(f"[business_logic] Metrics on :{METRICS_PORT}/metrics")
+
+
+def mark_process_dead(pid):
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def observe_fill_latency(fills):
+    now = datetime.now(timezone.utc)
+
+    for fill in fills:
+        for side, order in (("buy", fill.buy), ("sell", fill.sell)):
+            if order.created_at is not None:
+                ORDER_TO_FILL_LATENCY.labels(side=side).observe(max(0.0, (now - order.created_at).total_seconds()))
+
+
+def report_open_orders(books, symbols=None):
+    """Updates the gauges of the given symbols, all of them (and zeroes the ones that are gone) if None."""
+    if symbols is None:
+        symbols = set(books) | reported_symbols
+
+    for symbol in symbols:
+        book = books.get(symbol)
+        buys = sum(1 for order in book.orders.values() if order.action == "buy") if book else 0
+        sells = len(book) - buys if book else 0
+
+        OPEN_ORDERS.labels(symbol=symbol, side="buy").set(buys)
+        OPEN_ORDERS.labels(symbol=symbol, side="sell").set(sells)
+
+        if buys or sells:
+            reported_symbols.add(symbol)
+        else:
+            reported_symbols.discard(symbol)
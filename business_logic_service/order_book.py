@@ -0,0 +1,119 @@
+import heapq
+import itertools
+from decimal import Decimal
+
+
+class Order:
+    __slots__ = ("id", "username", "symbol", "action", "price", "quantity",
+                 "created_at", "portfolio_price", "active", "traceparent")
+
+    def __init__(self, id, username, symbol, action, price, quantity, created_at, portfolio_price=None,
+                 traceparent=None):
+        self.id = id
+        self.username = username
+        self.symbol = symbol
+        self.action = action
+        self.price = Decimal(str(price))
+        self.quantity = quantity
+        self.created_at = created_at
+        self.portfolio_price = portfolio_price
+        self.active = True
+        # Trace of the request that placed or last edited the order, the settlement links to it
+        self.traceparent = traceparent
+
+    @classmethod
+    def from_trade(cls, trade, traceparent=None):
+        return cls(id=trade.id,
+                   username=trade.username,
+                   symbol=trade.symbol,
+                   action=trade.action,
+                   price=trade.price,
+                   quantity=trade.quantity,
+                   created_at=trade.created_at,
+                   portfolio_price=trade.portfolio_price,
+                   traceparent=traceparent)
+
+
+class Fill:
+    __slots__ = ("buy", "sell", "quantity", "price")
+
+    def __init__(self, buy, sell, quantity, price):
+        self.buy = buy
+        self.sell = sell
+        self.quantity = quantity
+        self.price = price
+
+
+class OrderBook:
+    """
+    Bid/ask book for a single symbol with price-time priority.
+
+    Both sides are binary heaps keyed on (price, created_at, id); bids use the
+    negated price so the best bid is always at the top. Removed or modified
+    orders are marked inactive and skipped lazily when they reach the top.
+    An insertion sequence follows the key: an order re-added with the same
+    key (an edit of its quantity only) never gets its entries compared by Order.
+    """
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = []
+        self.asks = []
+        self.orders = {}
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.orders)
+
+    def add(self, order):
+        if order.id in self.orders:
+            self.remove(order.id)
+
+        if order.action == "buy":
+            heapq.heappush(self.bids, (-order.price, order.created_at, order.id, next(self.sequence), order))
+        else:
+            heapq.heappush(self.asks, (order.price, order.created_at, order.id, next(self.sequence), order))
+
+        self.orders[order.id] = order
+
+    def remove(self, order_id):
+        order = self.orders.pop(order_id, None)
+
+        if order:
+            order.active = False
+
+        return order
+
+    def _top(self, heap):
+        # Discard cancelled / replaced entries sitting on top of the heap
+        while heap and not heap[0][-1].active:
+            heapq.heappop(heap)
+
+        return heap[0][-1] if heap else None
+
+    def match(self):
+        fills = []
+
+        while True:
+            buy = self._top(self.bids)
+            sell = self._top(self.asks)
+
+            if not buy or not sell or buy.price < sell.price:
+                break
+
+            matched_qty = min(buy.quantity, sell.quantity)
+
+            # Fills at the sell price whichever side rests (baseline semantics), the buyer gets refunded the difference
+            if matched_qty > 0:
+                fills.append(Fill(buy, sell, matched_qty, sell.price))
+
+            buy.quantity -= matched_qty
+            sell.quantity -= matched_qty
+
+            if buy.quantity <= 0:
+                self.remove(buy.id)
+
+            if sell.quantity <= 0:
+                self.remove(sell.id)
+
+        return fills
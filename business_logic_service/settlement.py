@@ -0,0 +1,220 @@
+import time
+from collections import defaultdict
+from decimal import Decimal
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from shared.events import publish_cache_invalidation
+from candles import refresh_candles
+from metrics import MATCH_PHASE_LATENCY, observe_fill_latency
+
+
+def values_clause(prefix, rows, types):
+    """Builds a bound VALUES list, e.g. (CAST(:u0_0 AS TEXT), CAST(:u0_1 AS NUMERIC)), ..."""
+    params = {}
+    tuples = []
+
+    for i, row in enumerate(rows):
+        placeholders = []
+
+        for j, (value, type_) in enumerate(zip(row, types)):
+            name = f"{prefix}{i}_{j}"
+            params[name] = value
+            placeholders.append(f"CAST(:{name} AS {type_})")
+
+        tuples.append("(" + ", ".join(placeholders) + ")")
+
+    return ", ".join(tuples), params
+
+
+class SettlementBatch:
+    """
+    Collects the fills of one match cycle and settles them in a single
+    transaction: one statement for the trades, one for the balances and one
+    for the holdings, whatever the number of fills.
+    """
+
+    def __init__(self):
+        self.fills = defaultdict(list)
+        # Where settle() got to, tells a failed statement from a failed commit
+        self.phase = "settle"
+
+    def __len__(self):
+        return sum(len(fills) for fills in self.fills.values())
+
+    def add(self, symbol, fills):
+        if fills:
+            self.fills[symbol].extend(fills)
+
+    def symbols(self):
+        return set(self.fills)
+
+    def traceparents(self):
+        return {order.traceparent for fills in self.fills.values() for fill in fills for order in (fill.buy, fill.sell)}
+
+    def settle(self, db: Session, shards=None):
+        """Commits the batch and returns the symbols whose fills were dropped because an order changed."""
+        stale = set()
+        started = time.perf_counter()
+
+        while self.fills:
+            if shards:
+                shards.fence(db, self.symbols())
+
+            stale_now = self._update_trades(db)
+
+            if stale_now:
+                # Someone edited or deleted a matched order, settle the other symbols without it
+                db.rollback()
+
+                for symbol in stale_now:
+                    self.fills.pop(symbol, None)
+
+                stale |= stale_now
+                continue
+
+            self._update_balances(db)
+            self._update_holdings(db)
+            self._insert_fills(db)
+
+            # The fills are stamped with the transaction's time, their candles are recomputed with them
+            refresh_candles(db, self.symbols())
+
+            # Cached balances and portfolios of both sides are dropped once this commits
+            for username in self._usernames():
+                publish_cache_invalidation(db, username)
+
+            committing = time.perf_counter()
+            MATCH_PHASE_LATENCY.labels(phase="settle").observe(committing - started)
+
+            self.phase = "commit"
+            db.commit()
+
+            MATCH_PHASE_LATENCY.labels(phase="commit").observe(time.perf_counter() - committing)
+            observe_fill_latency(fill for fills in self.fills.values() for fill in fills)
+            break
+
+        return stale
+
+    def _orders(self):
+        orders = {}
+        filled = defaultdict(int)
+
+        for fills in self.fills.values():
+            for fill in fills:
+                orders[fill.buy.id] = fill.buy
+                orders[fill.sell.id] = fill.sell
+                filled[fill.buy.id] += fill.quantity
+                filled[fill.sell.id] += fill.quantity
+
+        return orders, filled
+
+    def _usernames(self):
+        return {order.username for fills in self.fills.values() for fill in fills for order in (fill.buy, fill.sell)}
+
+    def _update_trades(self, db: Session):
+        orders, filled = self._orders()
+
+        rows = [
+            (order.id,
+             order.quantity,
+             "executed" if order.quantity == 0 else "unprocessed",
+             order.quantity + filled[order.id],
+             order.created_at)
+            for order in orders.values()
+        ]
+        clause, params = values_clause("t", rows, ["INTEGER", "INTEGER", "TEXT", "INTEGER", "TIMESTAMPTZ"])
+
+        # Only rows still in the state the book was loaded from are updated
+        updated = db.execute(text(f"""
+            UPDATE trades
+            SET quantity = v.quantity, flag = v.flag
+            FROM (VALUES {clause}) AS v(id, quantity, flag, expected_quantity, created_at)
+            WHERE trades.id = v.id
+              AND trades.flag = 'unprocessed'
+              AND trades.quantity = v.expected_quantity
+              AND trades.created_at = v.created_at
+            RETURNING trades.id
+        """), params).scalars().all()
+
+        missing = set(orders) - set(updated)
+
+        return {orders[trade_id].symbol for trade_id in missing}
+
+    def _update_balances(self, db: Session):
+        deltas = defaultdict(Decimal)
+
+        for fills in self.fills.values():
+            for fill in fills:
+                matched_qty = Decimal(str(fill.quantity))
+                total = matched_qty * fill.price
+
+                # The seller gets the sell price, the buyer is refunded the difference to his asking price
+                deltas[fill.sell.username] += total
+                deltas[fill.buy.username] += matched_qty * fill.buy.price - total
+
+        rows = [(username, delta) for username, delta in deltas.items() if delta != 0]
+
+        if not rows:
+            return
+
+        clause, params = values_clause("u", rows, ["TEXT", "NUMERIC"])
+
+        # Users are locked in username order so concurrent shards can't deadlock
+        updated = db.execute(text(f"""
+            WITH v(username, delta) AS (VALUES {clause}),
+            locked AS (
+                SELECT users.username FROM users
+                WHERE users.username IN (SELECT username FROM v)
+                ORDER BY users.username
+                FOR UPDATE
+            )
+            UPDATE users
+            SET balance = users.balance + v.delta
+            FROM v JOIN locked ON locked.username = v.username
+            WHERE users.username = v.username
+            RETURNING users.username
+        """), params).scalars().all()
+
+        if len(updated) != len(rows):
+            missing = {username for username, _ in rows} - set(updated)
+            raise Exception(f"[business_logic] Users {sorted(missing)} not found")
+
+    def _update_holdings(self, db: Session):
+        quantities = defaultdict(int)
+        costs = defaultdict(Decimal)
+
+        for symbol, fills in self.fills.items():
+            for fill in fills:
+                quantities[(fill.buy.username, symbol)] += fill.quantity
+                costs[(fill.buy.username, symbol)] += Decimal(str(fill.quantity)) * fill.price
+
+        rows = [(username, symbol, quantity, costs[(username, symbol)])
+                for (username, symbol), quantity in quantities.items()]
+        clause, params = values_clause("p", rows, ["TEXT", "TEXT", "INTEGER", "NUMERIC"])
+
+        # Insert new holdings, add to existing ones recalculating the average price.
+        # The exact cost is read back from v, EXCLUDED.price is already rounded to cents
+        db.execute(text(f"""
+            WITH v(username, symbol, quantity, cost) AS (VALUES {clause})
+            INSERT INTO portfolio (username, symbol, quantity, price)
+            SELECT v.username, v.symbol, v.quantity, v.cost / v.quantity
+            FROM v
+            ON CONFLICT (username, symbol) DO UPDATE
+            SET price = (portfolio.price * portfolio.quantity
+                         + (SELECT v.cost FROM v WHERE v.username = EXCLUDED.username AND v.symbol = EXCLUDED.symbol))
+                        / (portfolio.quantity + EXCLUDED.quantity),
+                quantity = portfolio.quantity + EXCLUDED.quantity
+        """), params)
+
+    def _insert_fills(self, db: Session):
+        rows = [(fill.buy.id, fill.sell.id, symbol, fill.quantity, fill.price,
+                 fill.buy.username, fill.sell.username, fill.sell.portfolio_price)
+                for symbol, fills in self.fills.items() for fill in fills]
+        clause, params = values_clause("f", rows, ["INTEGER", "INTEGER", "TEXT", "INTEGER", "NUMERIC",
+                                                   "TEXT", "TEXT", "NUMERIC"])
+
+        db.execute(text(f"""
+            INSERT INTO fills (buy_trade_id, sell_trade_id, symbol, quantity, price, buyer, seller, cost_basis)
+            VALUES {clause}
+        """), params)
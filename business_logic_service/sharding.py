@@ -0,0 +1,143 @@
+import os
+import random
+import zlib
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from shared.database import engine
+from shared.events import SHARD_REBALANCE_CHANNEL
+
+# Symbols are hashed into SHARD_COUNT shards, every matcher worker owns a subset of them
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "16"))
+
+# Matcher processes per replica
+MATCHER_WORKERS = int(os.getenv("MATCHER_WORKERS", "1"))
+
+# First key of the two-key advisory locks, keeps the shard locks apart from any other advisory lock
+SHARD_LOCK_CLASS = 7301
+# Every live worker holds one lock of this class (keyed by its backend pid), the members are read from pg_locks
+MEMBER_LOCK_CLASS = 7302
+
+
+class ShardLostError(Exception):
+    pass
+
+
+def shard_of(symbol: str) -> int:
+    return zlib.crc32(symbol.encode()) % SHARD_COUNT
+
+
+class ShardOwner:
+    """
+    Owns shards through session-level advisory locks held on a dedicated
+    connection. If the process dies the connection goes away and Postgres
+    releases the locks, so another worker can take the shards over.
+
+    The shards are spread over the live workers (the holders of a member
+    lock): nobody holds more than ceil(SHARD_COUNT / members), and while a
+    worker sits below floor(SHARD_COUNT / members), e.g. one that just
+    started, the others give back what they hold above the floor.
+    """
+
+    def __init__(self):
+        self.owned = set()
+
+        self.raw = engine.raw_connection()
+        self.conn = self.raw.driver_connection
+        self.raw.detach()
+        self.conn.autocommit = True
+
+        with self.conn.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            self.pid = cursor.fetchone()[0]
+            cursor.execute("SELECT pg_advisory_lock(%s, %s)", (MEMBER_LOCK_CLASS, self.pid))
+
+    def shares(self, cursor) -> dict:
+        """Number of shards held by every live worker, by backend pid."""
+        cursor.execute(
+            "SELECT member.pid, count(shard.objid) FROM pg_locks member "
+            "LEFT JOIN pg_locks shard ON shard.pid = member.pid AND shard.locktype = 'advisory' "
+            "AND shard.classid = %s AND shard.objsubid = 2 AND shard.granted "
+            "WHERE member.locktype = 'advisory' AND member.classid = %s AND member.objsubid = 2 AND member.granted "
+            "GROUP BY member.pid",
+            (SHARD_LOCK_CLASS, MEMBER_LOCK_CLASS)
+        )
+        return dict(cursor.fetchall())
+
+    def quota(self, cursor) -> int:
+        """How many shards this worker may hold right now."""
+        shares = self.shares(cursor)
+        members = max(len(shares), 1)
+        floor, ceil = SHARD_COUNT // members, -(-SHARD_COUNT // members)
+
+        # Stay at the floor until the workers below it caught up, or they never get a shard
+        if any(count < floor for pid, count in shares.items() if pid != self.pid):
+            return floor
+
+        return ceil
+
+    def claim(self):
+        """Takes free shards up to the quota, returns the ones acquired."""
+        # Start at a random shard so workers starting together don't all race for the same locks
+        offset = random.randrange(SHARD_COUNT)
+        acquired = set()
+
+        with self.conn.cursor() as cursor:
+            quota = self.quota(cursor)
+
+            for i in range(SHARD_COUNT):
+                if len(self.owned) >= quota:
+                    break
+
+                shard = (offset + i) % SHARD_COUNT
+
+                if shard in self.owned:
+                    continue
+
+                cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (SHARD_LOCK_CLASS, shard))
+
+                if cursor.fetchone()[0]:
+                    self.owned.add(shard)
+                    acquired.add(shard)
+
+        return acquired
+
+    def rebalance(self):
+        """
+        Gives back the shards above the quota (a worker joined or is waiting for
+        shards) and wakes the other workers up to claim them, returns them.
+        """
+        with self.conn.cursor() as cursor:
+            surplus = set(random.sample(sorted(self.owned), max(0, len(self.owned) - self.quota(cursor))))
+
+            for shard in surplus:
+                cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (SHARD_LOCK_CLASS, shard))
+                self.owned.discard(shard)
+
+            if surplus:
+                cursor.execute("SELECT pg_notify(%s, %s)", (SHARD_REBALANCE_CHANNEL, str(self.pid)))
+
+        return surplus
+
+    def owns(self, symbol: str) -> bool:
+        return shard_of(symbol) in self.owned
+
+    def fence(self, db: Session, symbols):
+        # Checked inside the settlement transaction, a worker whose lock connection
+        # was dropped must not settle fills for shards someone else may own by now
+        shards = {shard_of(symbol) for symbol in symbols}
+
+        held = db.execute(
+            text("SELECT CAST(objid AS BIGINT) FROM pg_locks WHERE locktype = 'advisory' "
+                 "AND classid = :classid AND objsubid = 2 AND pid = :pid AND granted"),
+            {"classid": SHARD_LOCK_CLASS, "pid": self.pid}
+        ).scalars().all()
+
+        lost = shards - set(held)
+
+        if lost:
+            raise ShardLostError(f"Lost the lock on shards {sorted(lost)}")
+
+    def close(self):
+        self.owned = set()
+        self.raw.close()
@@ -1,74 +1,103 @@
-from fastapi import FastAPI, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, Header, Query
+from sqlalchemy import insert, select, text, tuple_, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
 from decimal import Decimal
 from datetime import datetime, timezone
 from jose import jwt
+import asyncio
+import base64
+import csv
+import io
+import json
 import os
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from starlette.responses import Response
-from time import time
-
-from shared.database import SessionLocal
-from shared.models import User, Portfolio, Trade
-from shared.schemas import BalanceUpdate, PortfolioItem, TradeItem, TradeUpdate
-from typing import List
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from shared.database import AsyncSessionLocal, QueryProfilerMiddleware, check_schema, warm_up_pool
+from shared.health import add_health_endpoints
+from shared.cache import CACHE_BACKEND, create_user_cache, start_invalidation_listener
+from shared.events import publish_cache_invalidation, publish_order_event
+from shared.metrics import MetricsMiddleware
+from shared.models import Candle, User, Portfolio, Trade, TradeHistory
+from shared.tracing import TracingMiddleware, setup_tracing, span
+from shared.schemas import BalanceUpdate, CandleRecord, OrderEvent, PortfolioItem, PortfolioValuation, TradeBatch, TradeItem, TradePage, TradeRecord, TradeResult, TradeUpdate, normalize_symbol
+from typing import List, Literal, Optional
+from token_cache import TokenCache
+from valuation import fetch_quotes, value_portfolio, warm_up_valuation
+
+setup_tracing("db_interaction_service")
 
 app = FastAPI()
 
-# Prometheus metrics
-REQUEST_COUNT = Counter(
-    'db_interaction_service_requests_total',
-    'Total number of requests',
-    ['method', 'endpoint', 'status']
-)
+# Prometheus metrics, labelled by route template
+app.add_middleware(MetricsMiddleware, service="db_interaction_service")
+
+# Statements and database time per request, only with DB_PROFILING=true
+app.add_middleware(QueryProfilerMiddleware)
+
+# Server span per request continuing Kong's trace, outermost so it covers the other middlewares
+app.add_middleware(TracingMiddleware)
+
+# /healthz, and /readyz once the connections are open and NumPy is loaded
+add_health_endpoints(app, "db_interaction", warm_up_pool, warm_up_valuation, requires=[check_schema])
+
+# Most orders a single /add_trades request may place
+MAX_BATCH_TRADES = int(os.getenv("MAX_BATCH_TRADES", "500"))
+
+# Trade history: largest /get_trades page and rows fetched per round trip by /export_trades
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
 
-REQUEST_LATENCY = Histogram(
-    'db_interaction_service_request_latency_seconds',
-    'Request latency in seconds',
-    ['method', 'endpoint']
-)
+# Most candles a single /get_candles request returns
+MAX_CANDLES = int(os.getenv("MAX_CANDLES", "1000"))
 
 # JWT config
 SECRET_KEY = os.getenv("JWT_SECRET")
 ALGORITHM = os.getenv("JWT_ALGORITHM")
 
-def get_main_db():
-    db = SessionLocal()
+# Verified tokens are cached until their exp, the signature is only checked once per token
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+token_cache = TokenCache(TOKEN_CACHE_SIZE)
 
-    try:
+# Kong has already verified the JWT and passes its subject in X-Authenticated-Userid (see kong.yml).
+# Only enable when the service can't be reached without going through Kong
+TRUSTED_GATEWAY = os.getenv("TRUSTED_GATEWAY", "false").lower() == "true"
+
+# Balance and portfolio responses, invalidated by every write path and by the matcher's fills
+user_cache = create_user_cache()
+
+
+@app.on_event("startup")
+async def start_cache_invalidation():
+    if CACHE_BACKEND != "none":
+        start_invalidation_listener(user_cache, asyncio.get_running_loop())
+
+
+async def get_main_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_sub_from_jwt(authorization: str = Header(...)) -> str:
+async def get_sub_from_jwt(authorization: Optional[str] = Header(None),
+                           x_authenticated_userid: Optional[str] = Header(None)) -> str:
+    if TRUSTED_GATEWAY and x_authenticated_userid:
+        return x_authenticated_userid
+
     try:
         token = authorization.split(" ")[1]
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = token_cache.get(token)
+
+        if payload is None:
+            with span("jwt.verify", attributes={"jwt.algorithm": ALGORITHM}):
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+            token_cache.put(token, payload)
+
         return payload["sub"]
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid token")
     
 
-# Middleware to track metrics
-@app.middleware("http")
-async def track_metrics(request, call_next):
-    start_time = time()
-    method = request.method
-    endpoint = request.url.path
-
-    try:
-        response = await call_next(request)
-        status_code = response.status_code
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status_code).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time() - start_time)
-        return response
-    except Exception as e:
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=500).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time() - start_time)
-        raise e
-
-
 # Metrics endpoint
 @app.get("/metrics")
 async def metrics():
@@ -77,322 +106,708 @@ async def metrics():
 
 # Balance endpoints
 @app.get("/get_balance")
-def get_balance(username: str = Depends(get_sub_from_jwt),
-                db: Session = Depends(get_main_db)):
+async def get_balance(username: str = Depends(get_sub_from_jwt),
+                      db: AsyncSession = Depends(get_main_db)):
     
-    user = db.query(User).filter(User.username == username).first()
+    async def load():
+        user = await db.scalar(select(User).where(User.username == username))
 
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        return {"username": username, "balance": float(user.balance)}
     
-    return {"username": username, "balance": float(user.balance)}
+    return await user_cache.get("balance", username, load)
 
 
 @app.post("/add_balance")
-def add_balance(update: BalanceUpdate,
-                username: str = Depends(get_sub_from_jwt),
-                db: Session = Depends(get_main_db)):
-    
-    user = db.query(User).filter(User.username == username).first()
-
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def add_balance(update: BalanceUpdate,
+                      username: str = Depends(get_sub_from_jwt),
+                      db: AsyncSession = Depends(get_main_db)):
     
     if update.amount < 0:
         raise HTTPException(status_code=400, detail="Amount must be positive")
     
-    user.balance += Decimal(str(update.amount))
-    user.added_balance += Decimal(str(update.amount))
+    amount = Decimal(str(update.amount))
 
     try:
-        db.commit()
+        new_balance = await db.scalar(text("""
+            UPDATE users
+            SET balance = balance + :amount, added_balance = added_balance + :amount
+            WHERE username = :username
+            RETURNING balance
+        """), {"username": username, "amount": amount})
+
+        if new_balance is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        publish_cache_invalidation(db, username)
+        await db.commit()
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[db_interaction/add_balance] Commit failed: {e}")
-        db.rollback()
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to update balance")
 
-    db.refresh(user)
+    await user_cache.invalidate(username)
 
-    return {"msg": f"Balance updated", "new_balance": float(user.balance)}
+    return {"msg": f"Balance updated", "new_balance": float(new_balance)}
 
 
 @app.post("/remove_balance")
-def remove_balance(update: BalanceUpdate,
-                   username: str = Depends(get_sub_from_jwt),
-                   db: Session = Depends(get_main_db)):
+async def remove_balance(update: BalanceUpdate,
+                         username: str = Depends(get_sub_from_jwt),
+                         db: AsyncSession = Depends(get_main_db)):
     
-    user = db.query(User).filter(User.username == username).first()
-
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    if update.amount < 0:
+        raise HTTPException(status_code=400, detail="Amount must be positive")
     
     amount = Decimal(str(update.amount))
 
-    if user.balance < amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-    
-    user.balance -= amount
-
     try:
-        db.commit()
+        # The check and the debit are one statement, two concurrent withdrawals can't both pass the check
+        new_balance = await db.scalar(text("""
+            UPDATE users
+            SET balance = balance - :amount
+            WHERE username = :username AND balance >= :amount
+            RETURNING balance
+        """), {"username": username, "amount": amount})
+
+        if new_balance is None:
+            await raise_user_not_found(db, username, "Insufficient balance")
+        
+        publish_cache_invalidation(db, username)
+        await db.commit()
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"[db_interaction/remove_balance] Commit failed: {e}")
-        db.rollback()
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to update balance")
+
+    await user_cache.invalidate(username)
+
+    return {"msg": f"Balance removed", "new_balance": float(new_balance)}
+
+
+async def raise_user_not_found(db: AsyncSession, username: str, detail: str):
+    # A conditional update matched nothing: either the user doesn't exist or the condition failed
+    if await db.scalar(select(User.id).where(User.username == username)) is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    raise HTTPException(status_code=400, detail=detail)
+
 
-    db.refresh(user)
+async def raise_trade_not_found(db: AsyncSession, trade_id: int, username: str, detail: str):
+    # Not in trades: either it doesn't exist or it was executed and archived to trades_history
+    archived = await db.scalar(select(TradeHistory.id).where(
+        TradeHistory.id == trade_id,
+        TradeHistory.username == username
+    ))
 
-    return {"msg": f"Balance removed", "new_balance": float(user.balance)}
+    if archived is None:
+        raise HTTPException(status_code=404, detail="Trade not found")
+    
+    raise HTTPException(status_code=400, detail=detail)
+
+
+# Buy: the cost is debited and the order inserted by one statement, nothing is inserted if the balance is short
+BUY_ORDER = text("""
+    WITH debit AS (
+        UPDATE users
+        SET balance = balance - :cost
+        WHERE username = :username AND balance >= :cost
+        RETURNING username
+    )
+    INSERT INTO trades (username, symbol, quantity, price, action, created_at, flag, portfolio_price)
+    SELECT username, :symbol, :quantity, :price, 'buy', :created_at, :flag, -1
+    FROM debit
+    RETURNING id
+""")
+
+# Sell: the holding is locked, then either deleted (all shares sold) or decremented,
+# and the order is inserted with the average price the shares were taken at
+SELL_ORDER = text("""
+    WITH holding AS (
+        SELECT id, quantity, price FROM portfolio
+        WHERE username = :username AND symbol = :symbol AND quantity >= :quantity
+        FOR UPDATE
+    ),
+    removed AS (
+        DELETE FROM portfolio USING holding
+        WHERE portfolio.id = holding.id AND holding.quantity = :quantity
+        RETURNING holding.price
+    ),
+    decremented AS (
+        UPDATE portfolio
+        SET quantity = holding.quantity - :quantity
+        FROM holding
+        WHERE portfolio.id = holding.id AND holding.quantity > :quantity
+        RETURNING holding.price
+    )
+    INSERT INTO trades (username, symbol, quantity, price, action, created_at, flag, portfolio_price)
+    SELECT :username, :symbol, :quantity, :price, 'sell', :created_at, :flag, taken.price
+    FROM (SELECT price FROM removed UNION ALL SELECT price FROM decremented) AS taken
+    RETURNING id
+""")
 
 
 # Trade endpoint
 @app.post("/add_trade")
-def add_trade(trade: TradeItem,
-              username: str = Depends(get_sub_from_jwt),
-              main_db: Session = Depends(get_main_db)):
-    
-    user = main_db.query(User).filter(User.username == username).first()
+async def add_trade(trade: TradeItem,
+                    username: str = Depends(get_sub_from_jwt),
+                    main_db: AsyncSession = Depends(get_main_db)):
     
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    params = {
+        "username": username,
+        "symbol": trade.symbol,
+        "quantity": trade.quantity,
+        "price": Decimal(str(trade.price)),
+        "flag": trade.flag,
+        "created_at": datetime.now(timezone.utc),
+    }
 
-    total_cost = Decimal(str(trade.quantity * trade.price))
+    try:
+        if trade.action == "buy":
+            params["cost"] = Decimal(str(trade.quantity * trade.price))
+            trade_id = await main_db.scalar(BUY_ORDER, params)
 
-    portfolio_price = Decimal("-1")
+            if trade_id is None:
+                await raise_user_not_found(main_db, username, "Insufficient balance for buy order")
 
-    if trade.action == "buy":
-        if user.balance < total_cost:
-            raise HTTPException(status_code=400, detail="Insufficient balance for buy order")
+        elif trade.action == "sell":
+            trade_id = await main_db.scalar(SELL_ORDER, params)
 
-        user.balance -= total_cost 
+            if trade_id is None:
+                await raise_user_not_found(main_db, username, f"Insufficient shares of {trade.symbol} to sell")
+
+        else:
+            raise HTTPException(status_code=400, detail="Invalid trade action")
         
-        try:
-            main_db.commit()
-        except Exception as e:
-            print(f"[db_interaction/add_trade] Commit failed: {e}")
-            main_db.rollback()
+        # Wake up the matcher, delivered only if the commit goes through
+        publish_order_event(main_db, OrderEvent(action="add", trade_id=trade_id, symbol=trade.symbol))
+        publish_cache_invalidation(main_db, username)
+        await main_db.commit()
 
-        main_db.refresh(user)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[db_interaction/add_trade] Commit failed: {e}")
+        await main_db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to add trade")
+        
+    await user_cache.invalidate(username)
 
-    elif trade.action == "sell":
-        holding = main_db.query(Portfolio).filter(
-            Portfolio.username == username,
-            Portfolio.symbol == trade.symbol
-        ).first()
+    return {"msg": "Trade added", "trade_id": trade_id}
 
-        if not holding or holding.quantity < trade.quantity:
-            raise HTTPException(status_code=400, detail=f"Insufficient shares of {trade.symbol} to sell")
 
-        # Remove shares from portfolio
-        holding.quantity -= trade.quantity
-        portfolio_price = holding.price
+@app.post("/add_trades")
+async def add_trades(batch: TradeBatch,
+                     username: str = Depends(get_sub_from_jwt),
+                     db: AsyncSession = Depends(get_main_db)):
+    
+    if not batch.trades:
+        raise HTTPException(status_code=400, detail="No trades given")
+    
+    if len(batch.trades) > MAX_BATCH_TRADES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_TRADES} trades per request")
+    
+    try:
+        # Lock the user and the holdings being sold, the whole batch is validated against them once
+        balance = await db.scalar(select(User.balance).where(User.username == username).with_for_update())
 
-        if holding.quantity == 0:
-            try:
-                main_db.delete(holding)
+        if balance is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        sell_symbols = sorted({trade.symbol for trade in batch.trades if trade.action == "sell"})
+        holdings = {}
 
-            except Exception as e:
-                print(f"[db_interaction/add_trade] Error deleting holding: {e}")
-                main_db.rollback()
+        if sell_symbols:
+            rows = await db.execute(select(Portfolio.id, Portfolio.symbol, Portfolio.quantity, Portfolio.price).where(
+                Portfolio.username == username,
+                Portfolio.symbol.in_(sell_symbols)
+            ).order_by(Portfolio.symbol).with_for_update())
+            holdings = {row.symbol: {"id": row.id, "quantity": row.quantity, "price": row.price} for row in rows}
 
-        try:
-            main_db.commit()
+        # Orders are accepted in the order given as long as what's left covers them
+        results = [TradeResult(index=index) for index in range(len(batch.trades))]
+        accepted = []
+        total_cost = Decimal("0")
+        sold = set()
 
-        except Exception as e:
-            print(f"[db_interaction/add_trade] Commit failed: {e}")
-            main_db.rollback()
+        for result, trade in zip(results, batch.trades):
+            if trade.action not in ("buy", "sell"):
+                result.error = "Invalid trade action"
+                continue
 
-        main_db.refresh(user)
+            portfolio_price = Decimal("-1")
 
-    else:
-        raise HTTPException(status_code=400, detail="Invalid trade action")
-    
+            if trade.action == "buy":
+                cost = Decimal(str(trade.quantity * trade.price))
 
-    new_trade = Trade(username=username,
-                      portfolio_price=portfolio_price,
-                      **trade.model_dump(exclude={"created_at"}))
+                if balance - total_cost < cost:
+                    result.error = "Insufficient balance for buy order"
+                    continue
 
-    try:
-        main_db.add(new_trade)
-        main_db.commit()
-    except Exception as e:
-        print(f"[db_interaction/add_trade] Commit failed: {e}")
-        main_db.rollback()
+                total_cost += cost
+
+            else:
+                holding = holdings.get(trade.symbol)
+
+                if not holding or holding["quantity"] < trade.quantity:
+                    result.error = f"Insufficient shares of {trade.symbol} to sell"
+                    continue
+
+                holding["quantity"] -= trade.quantity
+                portfolio_price = holding["price"]
+                sold.add(trade.symbol)
+
+            accepted.append((result, trade, portfolio_price))
+
+        rejected = len(batch.trades) - len(accepted)
+
+        if not accepted or (batch.all_or_nothing and rejected):
+            await db.rollback()
+
+            for result in results:
+                result.error = result.error or "Not placed, another order of the batch was rejected"
+
+            return JSONResponse(status_code=400, content={
+                "msg": "No trades added",
+                "results": [result.model_dump() for result in results]
+            })
         
-    main_db.refresh(new_trade)
+        if total_cost:
+            await db.execute(text("UPDATE users SET balance = balance - :amount WHERE username = :username"),
+                             {"username": username, "amount": total_cost})
+
+        if sold:
+            ids = [holdings[symbol]["id"] for symbol in sold]
+            quantities = [holdings[symbol]["quantity"] for symbol in sold]
+
+            await db.execute(text("""
+                UPDATE portfolio SET quantity = v.quantity
+                FROM unnest(CAST(:ids AS INTEGER[]), CAST(:quantities AS INTEGER[])) AS v(id, quantity)
+                WHERE portfolio.id = v.id
+            """), {"ids": ids, "quantities": quantities})
+
+            await db.execute(text("DELETE FROM portfolio WHERE id = ANY(CAST(:ids AS INTEGER[])) AND quantity = 0"),
+                             {"ids": ids})
+
+        # One multi-row insert, ids come back in the order of the rows
+        created_at = datetime.now(timezone.utc)
+        trade_ids = (await db.scalars(insert(Trade).returning(Trade.id, sort_by_parameter_order=True), [
+            {
+                "username": username,
+                "symbol": trade.symbol,
+                "quantity": trade.quantity,
+                "price": Decimal(str(trade.price)),
+                "action": trade.action,
+                "flag": trade.flag,
+                "created_at": created_at,
+                "portfolio_price": portfolio_price,
+            }
+            for result, trade, portfolio_price in accepted
+        ])).all()
+
+        for (result, trade, portfolio_price), trade_id in zip(accepted, trade_ids):
+            result.trade_id = trade_id
+            publish_order_event(db, OrderEvent(action="add", trade_id=trade_id, symbol=trade.symbol))
+
+        publish_cache_invalidation(db, username)
+        await db.commit()
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[db_interaction/add_trades] Commit failed: {e}")
+        await db.rollback()
+        raise HTTPException(status_code=500, detail="Failed to add trades")
+    
+    await user_cache.invalidate(username)
 
-    return {"msg": "Trade added", "trade_id": new_trade.id}
+    return {"msg": f"{len(accepted)} trades added, {rejected} rejected",
+            "results": [result.model_dump() for result in results]}
 
 
 @app.put("/edit_trade/{trade_id}")
-def edit_trade(trade_id: int,
-               update: TradeUpdate,
-               username: str = Depends(get_sub_from_jwt),
-               db: Session = Depends(get_main_db)):
+async def edit_trade(trade_id: int,
+                     update: TradeUpdate,
+                     username: str = Depends(get_sub_from_jwt),
+                     db: AsyncSession = Depends(get_main_db)):
     
-    # Get the trade
-    trade = db.query(Trade).filter(
+    # Get the trade, locked so the matcher can't settle it halfway through the edit
+    trade = await db.scalar(select(Trade).where(
         Trade.id == trade_id,
         Trade.username == username
-    ).first()
+    ).with_for_update())
 
     if not trade:
-        raise HTTPException(status_code=404, detail="Trade not found")
+        await raise_trade_not_found(db, trade_id, username, "Cannot edit processed trades")
     
     # Check if trade is already processed
     if trade.flag != "unprocessed":
         raise HTTPException(status_code=400, detail="Cannot edit processed trades")
     
+    publish_order_event(db, OrderEvent(action="edit", trade_id=trade.id, symbol=trade.symbol))
+    publish_cache_invalidation(db, username)
+
     try:
         if trade.action == "buy":
-            user = db.query(User).filter(User.username == username).first()
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-            
             # Calculate the difference in cost
             old_cost = Decimal(str(trade.quantity * trade.price))
             new_cost = Decimal(str(update.quantity * update.price)) if update.quantity is not None and update.price is not None else \
                       Decimal(str(update.quantity * trade.price)) if update.quantity is not None else \
                       Decimal(str(trade.quantity * update.price)) if update.price is not None else old_cost
             
-            # If increasing cost, check if user has enough balance
+            # If increasing cost, debit the difference if the balance covers it
             if new_cost > old_cost:
-                if user.balance < (new_cost - old_cost):
-                    raise HTTPException(status_code=400, detail="Insufficient balance for trade modification")
-                user.balance -= (new_cost - old_cost)
+                balance = await db.scalar(text("""
+                    UPDATE users SET balance = balance - :amount
+                    WHERE username = :username AND balance >= :amount
+                    RETURNING balance
+                """), {"username": username, "amount": new_cost - old_cost})
+
+                if balance is None:
+                    await raise_user_not_found(db, username, "Insufficient balance for trade modification")
+                
             # If decreasing cost, refund the difference
-            else:
-                user.balance += (old_cost - new_cost)
-            
-            # Update trade details
-            if update.quantity is not None:
-                trade.quantity = update.quantity
-            if update.price is not None:
-                trade.price = Decimal(str(update.price))
-            
-            # Update the timestamp
-            trade.created_at = datetime.now(timezone.utc)
-            
-            db.commit()
+            elif new_cost < old_cost:
+                balance = await db.scalar(text("""
+                    UPDATE users SET balance = balance + :amount
+                    WHERE username = :username
+                    RETURNING balance
+                """), {"username": username, "amount": old_cost - new_cost})
+
+                if balance is None:
+                    raise HTTPException(status_code=404, detail="User not found")
             
         elif trade.action == "sell":
-            holding = db.query(Portfolio).filter(
-                Portfolio.username == username,
-                Portfolio.symbol == trade.symbol
-            ).first()
-            
-            if not holding:
-                raise HTTPException(status_code=404, detail=f"No holding found for {trade.symbol}")
-            
             # Calculate the difference in quantity
             old_quantity = trade.quantity
             new_quantity = update.quantity if update.quantity is not None else old_quantity
             
-            # If increasing quantity, check if user has enough shares
+            # If increasing quantity, take the extra shares if the holding has them
             if new_quantity > old_quantity:
-                if holding.quantity < (new_quantity - old_quantity):
+                remaining = await db.scalar(text("""
+                    UPDATE portfolio SET quantity = quantity - :quantity
+                    WHERE username = :username AND symbol = :symbol AND quantity >= :quantity
+                    RETURNING quantity
+                """), {"username": username, "symbol": trade.symbol, "quantity": new_quantity - old_quantity})
+
+                if remaining is None:
                     raise HTTPException(status_code=400, detail=f"Insufficient shares of {trade.symbol} to modify trade")
-                holding.quantity -= (new_quantity - old_quantity)
+                
+                if remaining == 0:
+                    await db.execute(text("""
+                        DELETE FROM portfolio WHERE username = :username AND symbol = :symbol AND quantity = 0
+                    """), {"username": username, "symbol": trade.symbol})
+                
             # If decreasing quantity, return the difference to portfolio
-            else:
-                holding.quantity += (old_quantity - new_quantity)
+            elif new_quantity < old_quantity:
+                await return_shares(db, username, trade, old_quantity - new_quantity)
             
-            # Update trade details
-            if update.quantity is not None:
-                trade.quantity = update.quantity
-            if update.price is not None:
-                trade.price = Decimal(str(update.price))
-            
-            # Update the timestamp
-            trade.created_at = datetime.now(timezone.utc)
-            
-            db.commit()
+        # Update trade details
+        if update.quantity is not None:
+            trade.quantity = update.quantity
+        if update.price is not None:
+            trade.price = Decimal(str(update.price))
+        
+        # Update the timestamp
+        trade.created_at = datetime.now(timezone.utc)
+        
+        await db.commit()
             
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
         print(f"[db_interaction/edit_trade] Error: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to update trade")
     
+    await user_cache.invalidate(username)
+
     return {"msg": "Trade updated successfully", "trade_id": trade.id}
 
 
+# Creates the holding again if it was sold out, otherwise averages the price in
+RETURN_SHARES = text("""
+    INSERT INTO portfolio (username, symbol, quantity, price)
+    VALUES (:username, :symbol, :quantity, :price)
+    ON CONFLICT (username, symbol) DO UPDATE
+    SET price = (portfolio.price * portfolio.quantity + EXCLUDED.price * EXCLUDED.quantity)
+                / (portfolio.quantity + EXCLUDED.quantity),
+        quantity = portfolio.quantity + EXCLUDED.quantity
+""")
+
+
+async def return_shares(db: AsyncSession, username: str, trade: Trade, quantity: int):
+    # Use the stored original price from when the shares were removed
+    price = trade.portfolio_price if trade.portfolio_price > 0 else trade.price
+
+    await db.execute(RETURN_SHARES, {"username": username, "symbol": trade.symbol, "quantity": quantity, "price": price})
+
+
 @app.delete("/delete_trade/{trade_id}")
-def delete_trade(trade_id: int,
-                 username: str = Depends(get_sub_from_jwt),
-                 db: Session = Depends(get_main_db)):
+async def delete_trade(trade_id: int,
+                       username: str = Depends(get_sub_from_jwt),
+                       db: AsyncSession = Depends(get_main_db)):
     
-    # Get the trade
-    trade = db.query(Trade).filter(
+    # Get the trade, locked so the matcher can't settle it while it's being deleted
+    trade = await db.scalar(select(Trade).where(
         Trade.id == trade_id,
         Trade.username == username
-    ).first()
+    ).with_for_update())
 
     if not trade:
-        raise HTTPException(status_code=404, detail="Trade not found")
+        await raise_trade_not_found(db, trade_id, username, "Cannot delete processed trades")
     
     # Check if trade is already processed
     if trade.flag != "unprocessed":
         raise HTTPException(status_code=400, detail="Cannot delete processed trades")
     
+    publish_order_event(db, OrderEvent(action="delete", trade_id=trade.id, symbol=trade.symbol))
+    publish_cache_invalidation(db, username)
+
     try:
         if trade.action == "buy":
             # Refund the user's balance
-            user = db.query(User).filter(User.username == username).first()
-            if not user:
-                raise HTTPException(status_code=404, detail="User not found")
-            
             total_cost = Decimal(str(trade.quantity * trade.price))
-            user.balance += total_cost
+
+            balance = await db.scalar(text("""
+                UPDATE users SET balance = balance + :amount
+                WHERE username = :username
+                RETURNING balance
+            """), {"username": username, "amount": total_cost})
+
+            if balance is None:
+                raise HTTPException(status_code=404, detail="User not found")
             
         elif trade.action == "sell":
-            holding = db.query(Portfolio).filter(
-                Portfolio.username == username,
-                Portfolio.symbol == trade.symbol
-            ).first()
-
-            if holding:
-                # Update existing holding
-                old_quantity = holding.quantity
-                total_quantity = old_quantity + trade.quantity
-
-                # Use the stored original price from when the shares were removed
-                if trade.portfolio_price <= 0:
-                    trade_price = trade.price  # fallback
-                else:
-                    trade_price = trade.portfolio_price
-
-                holding.price = (
-                    (holding.price * old_quantity + trade_price * trade.quantity)
-                    / total_quantity
-                )
-                holding.quantity = total_quantity
-
-            else:
-                # Create new holding
-                holding = Portfolio(
-                    username=username,
-                    symbol=trade.symbol,
-                    quantity=trade.quantity,
-                    price=trade.portfolio_price if trade.portfolio_price > 0 else trade.price
-                )
-                db.add(holding)
+            await return_shares(db, username, trade, trade.quantity)
 
-        
         # Delete the trade
-        db.delete(trade)
-        db.commit()
+        await db.delete(trade)
+        await db.commit()
         
+    except HTTPException:
+        await db.rollback()
+        raise
     except Exception as e:
         print(f"[db_interaction/delete_trade] Error: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to delete trade")
     
+    await user_cache.invalidate(username)
+
     return {"msg": "Trade deleted successfully"}
 
 
 @app.get("/get_portfolio", response_model=List[PortfolioItem])
-def get_portfolio(username: str = Depends(get_sub_from_jwt),
-                  db: Session = Depends(get_main_db)):
+async def get_portfolio(username: str = Depends(get_sub_from_jwt),
+                        db: AsyncSession = Depends(get_main_db)):
+    
+    return await load_portfolio(db, username)
+
+
+async def load_portfolio(db: AsyncSession, username: str):
+    async def load():
+        holdings = (await db.scalars(select(Portfolio).where(Portfolio.username == username))).all()
+        return [PortfolioItem.model_validate(holding, from_attributes=True).model_dump() for holding in holdings]
+    
+    return await user_cache.get("portfolio", username, load)
+
+
+# Realized PnL per symbol: what the user's sells were filled at over the average price the shares were held at
+REALIZED_PNL = text("""
+    SELECT symbol, SUM(quantity * (price - cost_basis))
+    FROM fills
+    WHERE seller = :username AND cost_basis >= 0
+    GROUP BY symbol
+""")
+
+
+@app.get("/get_valuation", response_model=PortfolioValuation)
+async def get_valuation(username: str = Depends(get_sub_from_jwt),
+                        db: AsyncSession = Depends(get_main_db)):
+    
+    holdings = await load_portfolio(db, username)
+    realized = dict((await db.execute(REALIZED_PNL, {"username": username})).all())
+
+    quotes = await fetch_quotes([holding["symbol"] for holding in holdings]) if holdings else {}
+
+    return value_portfolio(holdings, quotes, realized)
+
+
+# Trade history
+HISTORY_COLUMNS = ["id", "symbol", "quantity", "price", "action", "flag", "created_at", "portfolio_price"]
+
+
+def trade_filters(model, username: str, symbol: Optional[str], action: Optional[str], flag: Optional[str]):
+    conditions = [model.username == username]
+
+    if symbol:
+        conditions.append(model.symbol == normalize_symbol(symbol))
+    if action:
+        conditions.append(model.action == action)
+    if flag:
+        conditions.append(model.flag == flag)
+
+    return conditions
+
+
+def trade_history(username: str, symbol: Optional[str], action: Optional[str], flag: Optional[str]):
+    """The user's trades from both the hot trades table and the archived trades_history, as one subquery."""
+    # Open orders are never archived
+    models = [Trade] if flag == "unprocessed" else [Trade, TradeHistory]
+
+    selects = [
+        select(*[getattr(model, column) for column in HISTORY_COLUMNS]).where(
+            *trade_filters(model, username, symbol, action, flag)
+        )
+        for model in models
+    ]
+
+    # Postgres pushes the cursor condition, order and limit into both sides (a Merge Append of two index scans)
+    return (union_all(*selects) if len(selects) > 1 else selects[0]).subquery("history")
+
+
+def trades_page(username: str, symbol: Optional[str], action: Optional[str], flag: Optional[str],
+                after: Optional[tuple], limit: int):
+    # Newest first. Keyset pagination: each page starts right after the cursor through the
+    # (username, created_at, id) indexes, however deep the page is
+    history = trade_history(username, symbol, action, flag)
+    statement = select(history).order_by(history.c.created_at.desc(), history.c.id.desc()).limit(limit)
+
+    if after:
+        statement = statement.where(tuple_(history.c.created_at, history.c.id) < after)
+
+    return statement
+
+
+def trades_export(username: str, symbol: Optional[str], action: Optional[str], flag: Optional[str]):
+    # Oldest first, read through a server-side cursor EXPORT_BATCH_SIZE rows at a time
+    history = trade_history(username, symbol, action, flag)
+
+    return select(history).order_by(history.c.created_at, history.c.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+
+# Cursors are opaque to clients: the (created_at, id) of the last trade of the previous page
+def encode_cursor(trade) -> str:
+    return base64.urlsafe_b64encode(json.dumps([trade.created_at.isoformat(), trade.id]).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, trade_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(trade_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@app.get("/get_trades", response_model=TradePage)
+async def get_trades(limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                     cursor: Optional[str] = None,
+                     symbol: Optional[str] = None,
+                     action: Optional[str] = None,
+                     flag: Optional[str] = None,
+                     username: str = Depends(get_sub_from_jwt),
+                     db: AsyncSession = Depends(get_main_db)):
+    
+    after = decode_cursor(cursor) if cursor else None
+    trades = (await db.execute(trades_page(username, symbol, action, flag, after, limit + 1))).all()
+
+    # One row more than asked tells whether there is a next page
+    next_cursor = encode_cursor(trades[limit - 1]) if len(trades) > limit else None
+
+    return {"trades": [TradeRecord.model_validate(trade, from_attributes=True) for trade in trades[:limit]],
+            "next_cursor": next_cursor}
+
+
+def export_record(row) -> dict:
+    return {
+        "id": row.id,
+        "symbol": row.symbol,
+        "quantity": row.quantity,
+        "price": float(row.price),
+        "action": row.action,
+        "flag": row.flag,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+        "portfolio_price": float(row.portfolio_price),
+    }
+
+
+@app.get("/export_trades")
+async def export_trades(format: Literal["ndjson", "csv"] = "ndjson",
+                        symbol: Optional[str] = None,
+                        action: Optional[str] = None,
+                        flag: Optional[str] = None,
+                        username: str = Depends(get_sub_from_jwt)):
+    
+    statement = trades_export(username, symbol, action, flag)
+
+    async def lines():
+        # Own session, the response is still streaming after the request's dependencies are gone
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(statement)
+
+            if format == "csv":
+                buffer = io.StringIO()
+                writer = csv.DictWriter(buffer, fieldnames=HISTORY_COLUMNS)
+                writer.writeheader()
+
+                async for rows in result.partitions():
+                    writer.writerows(export_record(row) for row in rows)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+
+                yield buffer.getvalue()
+
+            else:
+                async for rows in result.partitions():
+                    yield "".join(json.dumps(export_record(row)) + "\n" for row in rows)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+
+    return StreamingResponse(lines(), media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename=trades.{format}"})
+
+
+def candle_range(symbol: str, interval: str, start: Optional[datetime], end: Optional[datetime], limit: int):
+    # A range scan of the (symbol, interval, bucket_start) primary key: the first `limit`
+    # buckets from start, otherwise the last `limit` ones before end (or now), newest first
+    statement = select(Candle).where(Candle.symbol == normalize_symbol(symbol), Candle.interval == interval)
+
+    if start:
+        statement = statement.where(Candle.bucket_start >= start)
+    if end:
+        statement = statement.where(Candle.bucket_start < end)
+
+    if start:
+        return statement.order_by(Candle.bucket_start).limit(limit)
+
+    return statement.order_by(Candle.bucket_start.desc()).limit(limit)
+
+
+# Candles of the internal fills, kept up to date by the matcher (business_logic_service/candles.py)
+@app.get("/get_candles/{symbol}", response_model=List[CandleRecord])
+async def get_candles(symbol: str,
+                      interval: Literal["1m", "5m", "1h", "1d"] = "1m",
+                      start: Optional[datetime] = None,
+                      end: Optional[datetime] = None,
+                      limit: int = Query(500, ge=1, le=MAX_CANDLES),
+                      username: str = Depends(get_sub_from_jwt),
+                      db: AsyncSession = Depends(get_main_db)):
     
-    return db.query(Portfolio).filter(Portfolio.username == username).all()
+    candles = (await db.scalars(candle_range(symbol, interval, start, end, limit))).all()
 
+    # Oldest first
+    if not start:
+        candles = candles[::-1]
 
+    return [CandleRecord.model_validate(candle, from_attributes=True) for candle in candles]
@@ -0,0 +1,57 @@
+import hashlib
+import time
+from collections import OrderedDict
+from prometheus_client import Counter
+
+TOKEN_CACHE_REQUESTS = Counter(
+    'db_interaction_service_token_cache_requests_total',
+    'Verified token cache lookups by result (hit, miss)',
+    ['result']
+)
+
+
+class TokenCache:
+    """
+    Claims of already verified JWTs, keyed by the token's sha256 digest (the
+    token itself is never kept). Each entry expires at the token's exp, the
+    least recently used entries are dropped past max_size.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str):
+        key = self._key(token)
+        entry = self.entries.get(key)
+
+        if entry:
+            claims, expires_at = entry
+
+            if expires_at > time.time():
+                self.entries.move_to_end(key)
+                TOKEN_CACHE_REQUESTS.labels(result="hit").inc()
+                return claims
+
+            del self.entries[key]
+
+        TOKEN_CACHE_REQUESTS.labels(result="miss").inc()
+        return None
+
+    def put(self, token: str, claims: dict):
+        # Tokens without exp would never expire from the cache, they are verified every time
+        expires_at = claims.get("exp")
+
+        if not isinstance(expires_at, (int, float)):
+            return
+
+        key = self._key(token)
+        self.entries[key] = (claims, expires_at)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
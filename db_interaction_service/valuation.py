@@ -0,0 +1,121 @@
+import asyncio
+import importlib
+import math
+import os
+import httpx
+
+from shared.tracing import inject_headers, span
+
+FINANCE_SERVICE_URL = os.getenv("FINANCE_SERVICE_URL", "http://finance_service:8004")
+FINANCE_TIMEOUT = float(os.getenv("FINANCE_TIMEOUT", "5")) # seconds
+FINANCE_BATCH_SIZE = 50 # finance_service's MAX_BATCH_SYMBOLS
+
+client = None
+
+
+async def fetch_quotes(symbols):
+    """Quotes from finance_service's /stocks, symbol -> StockData dict, or the error for that symbol."""
+    global client
+
+    if client is None:
+        client = httpx.AsyncClient(base_url=FINANCE_SERVICE_URL, timeout=FINANCE_TIMEOUT)
+
+    async def fetch(batch):
+        try:
+            with span("GET /stocks", kind="client", attributes={"symbols": len(batch)}):
+                response = await client.get("/stocks", params={"symbols": ",".join(batch)}, headers=inject_headers())
+
+            response.raise_for_status()
+            return {quote["symbol"]: quote["data"] or quote["error"] for quote in response.json()}
+        except Exception as e:
+            print(f"[db_interaction/valuation] Quote request failed: {e}")
+            return {symbol: "Quote unavailable" for symbol in batch}
+
+    batches = [symbols[i:i + FINANCE_BATCH_SIZE] for i in range(0, len(symbols), FINANCE_BATCH_SIZE)]
+    quotes = {}
+
+    for result in await asyncio.gather(*(fetch(batch) for batch in batches)):
+        quotes.update(result)
+
+    return quotes
+
+
+async def warm_up_valuation():
+    """NumPy is only imported on first use (it is most of this module's import time), the warm-up does it."""
+    await asyncio.to_thread(importlib.import_module, "numpy")
+
+
+def _values(array):
+    return [None if math.isnan(value) else round(float(value), 2) for value in array]
+
+
+def _total(array):
+    import numpy as np
+
+    return round(float(np.nansum(array)), 2)
+
+
+def value_portfolio(holdings, quotes, realized):
+    """
+    holdings: [{symbol, quantity, price}], quotes: symbol -> StockData dict or error,
+    realized: symbol -> realized PnL. All the holdings are valued at once on arrays,
+    a holding without a quote gets None values and is left out of the totals.
+    """
+    import numpy as np
+
+    symbols = [holding["symbol"] for holding in holdings]
+    priced = [isinstance(quotes.get(symbol), dict) for symbol in symbols]
+
+    quantity = np.array([holding["quantity"] for holding in holdings], dtype=float)
+    average_price = np.array([holding["price"] for holding in holdings], dtype=float)
+    current_price = np.array([quotes[symbol]["current_price"] if ok else np.nan
+                              for symbol, ok in zip(symbols, priced)], dtype=float)
+    change_amount = np.array([quotes[symbol]["change_amount"] if ok else np.nan
+                              for symbol, ok in zip(symbols, priced)], dtype=float)
+
+    market_value = quantity * current_price
+    cost_basis = quantity * average_price
+    unrealized = market_value - cost_basis
+    day_change = quantity * change_amount
+    total_value = np.nansum(market_value)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        unrealized_percent = np.where(cost_basis > 0, unrealized / cost_basis * 100, np.nan)
+        weight = market_value / total_value * 100 if total_value else np.full(len(holdings), np.nan)
+        previous_value = market_value - day_change
+        day_change_percent = np.where(previous_value > 0, day_change / previous_value * 100, np.nan)
+
+    columns = {
+        "current_price": _values(current_price),
+        "market_value": _values(market_value),
+        "cost_basis": _values(cost_basis),
+        "unrealized_pnl": _values(unrealized),
+        "unrealized_pnl_percent": _values(unrealized_percent),
+        "weight": _values(weight),
+        "day_change": _values(day_change),
+        "day_change_percent": _values(day_change_percent),
+    }
+
+    items = []
+
+    for i, (holding, ok) in enumerate(zip(holdings, priced)):
+        item = {
+            "symbol": holding["symbol"],
+            "quantity": holding["quantity"],
+            "average_price": holding["price"],
+            "realized_pnl": round(float(realized.get(holding["symbol"], 0)), 2),
+            "error": None if ok else quotes.get(holding["symbol"], "Quote unavailable"),
+        }
+        item.update({name: values[i] for name, values in columns.items()})
+        items.append(item)
+
+    priced_mask = np.array(priced, dtype=bool)
+
+    return {
+        "holdings": items,
+        "market_value": _total(market_value),
+        "cost_basis": _total(cost_basis[priced_mask]) if len(holdings) else 0.0,
+        "unrealized_pnl": _total(unrealized),
+        "day_change": _total(day_change),
+        "realized_pnl": round(float(sum(realized.values())), 2),
+    }
@@ -0,0 +1,174 @@
+import fcntl
+import functools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+from data_source import DataSource
+
+# Imported on first use, see data_source
+if TYPE_CHECKING:
+    import pandas as pd
+
+BAR_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+INTERVALS = {"1m", "2m", "5m", "15m", "30m", "60m", "90m", "1h", "1d", "5d", "1wk", "1mo", "3mo"}
+
+# Symbols end up in file names, e.g. AAPL, BRK-B, ^GSPC, EURUSD=X
+SYMBOL_PATTERN = re.compile(r"^[A-Z0-9^=\-][A-Z0-9^=.\-]{0,19}$")
+
+
+@functools.cache
+def periods():
+    """yfinance periods as offsets back from now, "max" has no start."""
+    import pandas as pd
+
+    return {
+        "1d": pd.offsets.BDay(1),
+        "5d": pd.offsets.BDay(5),
+        "1mo": pd.DateOffset(months=1),
+        "3mo": pd.DateOffset(months=3),
+        "6mo": pd.DateOffset(months=6),
+        "1y": pd.DateOffset(years=1),
+        "2y": pd.DateOffset(years=2),
+        "5y": pd.DateOffset(years=5),
+        "10y": pd.DateOffset(years=10),
+    }
+
+
+def period_start(period: str, now: "pd.Timestamp"):
+    if period == "max":
+        return None
+
+    if period == "ytd":
+        return now.normalize().replace(month=1, day=1)
+
+    if period not in periods():
+        raise ValueError(f"Invalid period {period}, valid periods: {', '.join(list(periods()) + ['ytd', 'max'])}")
+
+    return (now - periods()[period]).normalize()
+
+
+class BarStore:
+    """
+    On-disk OHLCV bars, one Parquet file per (symbol, interval) with a JSON
+    sidecar recording which range is covered and when the upstream was last asked.
+
+    Past bars never change: a request inside the covered range is answered from
+    disk and, once refresh_interval has passed, only the tail from the last stored
+    bar onwards (that bar may still have been forming) is fetched again.
+    """
+
+    def __init__(self, directory: str, source: DataSource, refresh_interval: float):
+        self.directory = directory
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def _paths(self, symbol, interval):
+        base = os.path.join(self.directory, interval, symbol)
+        return base + ".parquet", base + ".json"
+
+    def _lock(self, key):
+        with self.locks_lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    @contextmanager
+    def _locked(self, symbol, interval):
+        # The threads of this process, then the replicas sharing the volume: the data and its sidecar
+        # are read and replaced as a pair, and only one of them downloads a missing range
+        lock_path = os.path.join(self.directory, interval, symbol + ".lock")
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+
+        with self._lock((symbol, interval)), open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read(self, symbol, interval):
+        import pandas as pd
+
+        data_path, meta_path = self._paths(symbol, interval)
+
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+
+            return pd.read_parquet(data_path), meta
+        except (FileNotFoundError, ValueError):
+            return None, None
+
+    @staticmethod
+    def _replace(path, write):
+        # Written under a temporary name of its own then renamed, nobody ever reads half a file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _write(self, symbol, interval, bars, meta):
+        data_path, meta_path = self._paths(symbol, interval)
+
+        # Data first: a sidecar never describes bars that aren't on disk yet
+        self._replace(data_path, bars.to_parquet)
+        self._replace(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+
+    def _fetch(self, symbol, interval, start=None, period=None):
+        bars = self.source.history(symbol, interval, start=start, period=period)
+        return bars.reindex(columns=BAR_COLUMNS)
+
+    def get(self, symbol: str, interval: str, period: str) -> "pd.DataFrame":
+        import pandas as pd
+
+        if interval not in INTERVALS:
+            raise ValueError(f"Invalid interval {interval}, valid intervals: {', '.join(sorted(INTERVALS))}")
+
+        if not SYMBOL_PATTERN.match(symbol):
+            raise ValueError(f"Invalid symbol {symbol}")
+
+        now = pd.Timestamp.now(tz="UTC")
+        start = period_start(period, now)
+
+        with self._locked(symbol, interval):
+            bars, meta = self._read(symbol, interval)
+
+            covered = bars is not None and (
+                meta["covered_from"] == "max"
+                or (start is not None and pd.Timestamp(meta["covered_from"]) <= start)
+            )
+            stale = covered and time.time() - meta["fetched_at"] >= self.refresh_interval
+
+            if not covered or (stale and bars.empty):
+                # Nothing stored for this range yet, download all of it once
+                bars = self._fetch(symbol, interval, start=start, period=None if start is not None else "max")
+                meta = {
+                    "covered_from": start.isoformat() if start is not None else "max",
+                    "fetched_at": time.time(),
+                }
+                self._write(symbol, interval, bars, meta)
+
+            elif stale:
+                tail = self._fetch(symbol, interval, start=bars.index[-1])
+
+                if not tail.empty:
+                    bars = pd.concat([bars[bars.index < tail.index[0]], tail])
+                    bars = bars[~bars.index.duplicated(keep="last")].sort_index()
+
+                meta["fetched_at"] = time.time()
+                self._write(symbol, interval, bars, meta)
+
+        if start is None or bars.empty:
+            return bars
+
+        return bars[bars.index >= start]
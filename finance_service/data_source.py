@@ -0,0 +1,39 @@
+from typing import TYPE_CHECKING
+
+from shared.tracing import span
+
+# pandas and yfinance are most of the service's import time, they are imported on first use
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class DataSource:
+    """
+    Upstream market data. The service only talks to the upstream through this
+    interface, tests can plug in a fake one and run offline.
+    """
+
+    def info(self, symbol: str) -> dict:
+        raise NotImplementedError
+
+    def history(self, symbol: str, interval: str, start=None, period: str = None) -> "pd.DataFrame":
+        """OHLCV bars from start (or for the whole period), indexed by bar timestamp."""
+        raise NotImplementedError
+
+
+class YFinanceSource(DataSource):
+
+    def info(self, symbol: str) -> dict:
+        import yfinance as yf
+
+        with span("yfinance.info", kind="client", attributes={"symbol": symbol}):
+            return yf.Ticker(symbol).info
+
+    def history(self, symbol: str, interval: str, start=None, period: str = None) -> "pd.DataFrame":
+        import yfinance as yf
+
+        with span("yfinance.history", kind="client", attributes={"symbol": symbol, "interval": interval}):
+            if start is not None:
+                return yf.Ticker(symbol).history(start=start, interval=interval)
+
+            return yf.Ticker(symbol).history(period=period, interval=interval)
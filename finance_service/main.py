@@ -1,46 +1,64 @@
-from fastapi import FastAPI, HTTPException
-import yfinance as yf
-import pandas as pd
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from starlette.responses import Response
-from time import time
+import asyncio
+import importlib
+import io
+import json
+import os
 
-from shared.schemas import StockData, HistoricalData
-from typing import List
+from shared.health import add_health_endpoints
+from shared.metrics import MetricsMiddleware
+from shared.tracing import TracingMiddleware, setup_tracing
+from shared.schemas import StockData, StockQuote, HistoricalData, HistoricalDataColumnar
+from typing import TYPE_CHECKING, List, Literal, Union
+from quote_cache import QuoteCache
+from data_source import YFinanceSource
+from bar_store import BarStore
+from quote_hub import QuoteHub
+
+# pandas (and yfinance, see data_source) are imported on first use, or by the warm-up
+if TYPE_CHECKING:
+    import pandas as pd
+
+setup_tracing("finance_service")
 
 app = FastAPI()
 
-# Prometheus metrics
-REQUEST_COUNT = Counter(
-    'finance_service_requests_total',
-    'Total number of requests',
-    ['method', 'endpoint', 'status']
-)
-
-REQUEST_LATENCY = Histogram(
-    'finance_service_request_latency_seconds',
-    'Request latency in seconds',
-    ['method', 'endpoint']
-)
-
-# Middleware to track metrics
-@app.middleware("http")
-async def track_metrics(request, call_next):
-    start_time = time()
-    method = request.method
-    endpoint = request.url.path
+# Prometheus metrics, labelled by route template
+app.add_middleware(MetricsMiddleware, service="finance_service")
 
-    try:
-        response = await call_next(request)
-        status_code = response.status_code
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=status_code).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time() - start_time)
-        return response
-    except Exception as e:
-        REQUEST_COUNT.labels(method=method, endpoint=endpoint, status=500).inc()
-        REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time() - start_time)
-        raise e
+# Server span per request continuing Kong's trace, outermost so it covers the other middlewares
+app.add_middleware(TracingMiddleware)
+
+# Quote cache config (seconds), quotes move fast, company profiles hardly ever change
+QUOTE_TTL = float(os.getenv("QUOTE_TTL", "15"))
+QUOTE_STALE_TTL = float(os.getenv("QUOTE_STALE_TTL", "60"))
+PROFILE_TTL = float(os.getenv("PROFILE_TTL", "3600"))
+PROFILE_STALE_TTL = float(os.getenv("PROFILE_STALE_TTL", "86400"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "2000"))
+
+# Most symbols a single /stocks request may ask for
+MAX_BATCH_SYMBOLS = int(os.getenv("MAX_BATCH_SYMBOLS", "50"))
+
+# Streaming: how often each subscribed symbol is polled (through the quote cache, so
+# QUOTE_TTL bounds how fresh it gets) and how often idle streams get a heartbeat
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", "5"))
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", "15"))
+
+# History bars are kept on disk, the upstream is only asked for bars newer than the last stored one
+BAR_STORE_DIR = os.getenv("BAR_STORE_DIR", "/app/data/bars")
+BAR_REFRESH_INTERVAL = float(os.getenv("BAR_REFRESH_INTERVAL", "60"))
 
+# Quotes fetched into the cache by the warm-up, e.g. the most traded symbols (comma separated)
+WARM_UP_SYMBOLS = [symbol.strip().upper() for symbol in os.getenv("WARM_UP_SYMBOLS", "").split(",") if symbol.strip()]
+
+data_source = YFinanceSource()
+bar_store = BarStore(BAR_STORE_DIR, data_source, BAR_REFRESH_INTERVAL)
+
+quote_cache = QuoteCache("quote", QUOTE_TTL, QUOTE_STALE_TTL, CACHE_MAX_SIZE)
+profile_cache = QuoteCache("profile", PROFILE_TTL, PROFILE_STALE_TTL, CACHE_MAX_SIZE)
 
 # Metrics endpoint
 @app.get("/metrics")
@@ -48,73 +66,194 @@ async def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
+# Upstream call, runs on the cache's thread pool
+def fetch_info(symbol: str) -> dict:
+    return data_source.info(symbol)
+
+
+def stock_data_from_info(symbol: str, info: dict) -> StockData:
+    current_price = info.get('currentPrice', info.get('regularMarketPrice', 0))
+    previous_close = info.get('previousClose', current_price)
+    change_amount = current_price - previous_close
+    change_percent = (change_amount / previous_close) * 100 if previous_close else 0
+
+    return StockData(
+        symbol=symbol,
+        current_price=current_price,
+        change_percent=change_percent,
+        change_amount=change_amount,
+        volume=info.get('volume', 0),
+        market_cap=info.get('marketCap'),
+        pe_ratio=info.get('trailingPE'),
+        dividend_yield=info.get('dividendYield')
+    )
+
+
 @app.get("/stock/{symbol}", response_model=StockData)
-def get_stock_data(symbol: str):
+async def get_stock_data(symbol: str):
 
     try:
-        stock = yf.Ticker(symbol)
-        info = stock.info
+        info = await quote_cache.get(symbol.upper(), fetch_info)
         
         if not info:
             raise HTTPException(status_code=404, detail=f"Stock {symbol} not found")
         
-        current_price = info.get('currentPrice', info.get('regularMarketPrice', 0))
-        previous_close = info.get('previousClose', current_price)
-        change_amount = current_price - previous_close
-        change_percent = (change_amount / previous_close) * 100 if previous_close else 0
-        
-        return StockData(
-            symbol=symbol,
-            current_price=current_price,
-            change_percent=change_percent,
-            change_amount=change_amount,
-            volume=info.get('volume', 0),
-            market_cap=info.get('marketCap'),
-            pe_ratio=info.get('trailingPE'),
-            dividend_yield=info.get('dividendYield')
-        )
+        return stock_data_from_info(symbol, info)
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/stock/{symbol}/history", response_model=List[HistoricalData])
+async def get_quote(symbol: str) -> StockQuote:
+    # A failing symbol is reported in its own entry, the rest of the batch still goes through
+    try:
+        info = await quote_cache.get(symbol, fetch_info)
+
+        if not info:
+            return StockQuote(symbol=symbol, error=f"Stock {symbol} not found")
+
+        return StockQuote(symbol=symbol, data=stock_data_from_info(symbol, info))
+
+    except Exception as e:
+        return StockQuote(symbol=symbol, error=str(e))
+
+
+def parse_symbols(symbols: str) -> List[str]:
+    # Comma separated, duplicates are dropped, order is kept
+    requested = list(dict.fromkeys(s.strip().upper() for s in symbols.split(",") if s.strip()))
+
+    if not requested:
+        raise HTTPException(status_code=400, detail="No symbols given")
+    
+    if len(requested) > MAX_BATCH_SYMBOLS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SYMBOLS} symbols per request")
+    
+    return requested
+
+
+@app.get("/stocks", response_model=List[StockQuote])
+async def get_stocks(symbols: str):
+
+    requested = parse_symbols(symbols)
+
+    # The fetches run concurrently on the cache's upstream pool, which bounds them
+    return await asyncio.gather(*(get_quote(symbol) for symbol in requested))
+
+
+async def load_stream_quote(symbol: str):
+    info = await quote_cache.get(symbol, fetch_info)
+    return stock_data_from_info(symbol, info).model_dump() if info else None
+
+
+quote_hub = QuoteHub(load_stream_quote, STREAM_POLL_INTERVAL)
+
+
+def parquet_round_trip():
+    # pyarrow loads part of itself on the first read, a one-row frame goes through all of it
+    import pandas as pd
+
+    buffer = io.BytesIO()
+    pd.DataFrame({"Close": [1.0]}, index=pd.DatetimeIndex(["2024-01-02"], tz="UTC")).to_parquet(buffer)
+    buffer.seek(0)
+    pd.read_parquet(buffer)
+
+
+async def warm_up_libraries():
+    # pandas, its Parquet engine and yfinance, the first history or quote request would load them otherwise
+    await asyncio.to_thread(importlib.import_module, "yfinance")
+    await asyncio.to_thread(parquet_round_trip)
+
+
+async def warm_up_quotes():
+    # Best effort, a symbol failing upstream is fetched again by the first request asking for it
+    quotes = await asyncio.gather(*(get_quote(symbol) for symbol in WARM_UP_SYMBOLS))
+    failed = [quote.symbol for quote in quotes if quote.error]
+
+    if failed:
+        print(f"[finance/warm_up] No quote for {', '.join(failed)}")
+
+
+# /healthz, and /readyz once the libraries are loaded and the quote cache is primed
+add_health_endpoints(app, "finance", warm_up_libraries, warm_up_quotes)
+
+
+@app.get("/stocks/stream")
+async def stream_stocks(request: Request, symbols: str):
+
+    requested = parse_symbols(symbols)
+    subscription = quote_hub.subscribe(requested)
+
+    # Server-Sent Events: the first event of a symbol has all the fields, the next ones only what changed.
+    # The generator is only resumed once the previous event was sent, a slow client just gets conflated updates
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                changes = await subscription.next(STREAM_HEARTBEAT)
+
+                if changes is None:
+                    yield ": heartbeat\n\n"
+                    continue
+
+                for symbol, fields in changes.items():
+                    yield f"event: quote\ndata: {json.dumps({'symbol': symbol, **fields})}\n\n"
+        finally:
+            quote_hub.unsubscribe(subscription)
+
+    return StreamingResponse(events(),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Whole-column conversion of a yfinance history DataFrame, no per-row work in Python
+def history_columns(hist: "pd.DataFrame") -> dict:
+    return {
+        "date": hist.index.strftime("%Y-%m-%d").tolist(),
+        "open": hist["Open"].astype(float).tolist(),
+        "high": hist["High"].astype(float).tolist(),
+        "low": hist["Low"].astype(float).tolist(),
+        "close": hist["Close"].astype(float).tolist(),
+        "volume": hist["Volume"].astype("int64").tolist(),
+    }
+
+
+@app.get("/stock/{symbol}/history", response_model=Union[List[HistoricalData], HistoricalDataColumnar])
 def get_stock_history(symbol: str,
                       period: str = "1mo",
-                      interval: str = "1d"):
+                      interval: str = "1d",
+                      format: Literal["rows", "columnar"] = "rows"):
     
     try:
-        stock = yf.Ticker(symbol)
-        hist = stock.history(period=period, interval=interval)
+        hist = bar_store.get(symbol.upper(), interval, period)
         
         if hist.empty:
             raise HTTPException(status_code=404, detail=f"No historical data found for {symbol}")
         
-        # Convert DataFrame to list of HistoricalData objects
-        history_data = []
-
-        for index, row in hist.iterrows():
-
-            history_data.append(HistoricalData(
-                date=index.strftime("%Y-%m-%d"),
-                open=row['Open'],
-                high=row['High'],
-                low=row['Low'],
-                close=row['Close'],
-                volume=int(row['Volume'])
-            ))
-        
-        return history_data
+        columns = history_columns(hist)
+
+        # Returned as JSONResponse, the lists are already plain Python values and
+        # don't need to go through HistoricalData validation row by row
+        if format == "columnar":
+            return JSONResponse(columns)
+
+        keys = list(columns)
+
+        return JSONResponse([dict(zip(keys, row)) for row in zip(*columns.values())])
     
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/stock/{symbol}/search")
-def search_stock(symbol: str):
+async def search_stock(symbol: str):
 
     try:
-        stock = yf.Ticker(symbol)
-        info = stock.info
+        info = await profile_cache.get(symbol.upper(), fetch_info)
         
         if not info:
             raise HTTPException(status_code=404, detail=f"Stock {symbol} not found")
@@ -128,5 +267,7 @@ def search_stock(symbol: str):
             "industry": info.get('industry', '')
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
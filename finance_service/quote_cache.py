@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import Counter
+
+# Blocking upstream (yfinance) calls run here, never on the event loop
+UPSTREAM_WORKERS = int(os.getenv("UPSTREAM_WORKERS", "16"))
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_WORKERS, thread_name_prefix="upstream")
+
+CACHE_REQUESTS = Counter(
+    'finance_service_cache_requests_total',
+    'Quote cache lookups by result (hit, stale, miss, coalesced)',
+    ['cache', 'result']
+)
+
+CACHE_EVICTIONS = Counter(
+    'finance_service_cache_evictions_total',
+    'Entries evicted from the quote cache',
+    ['cache']
+)
+
+
+class QuoteCache:
+    """
+    In-process TTL cache with LRU eviction.
+
+    - fresh entries (younger than ttl) are served directly
+    - stale entries (younger than ttl + stale_ttl) are served while a refresh runs in the background
+    - concurrent misses for the same key share a single upstream fetch
+    """
+
+    def __init__(self, name: str, ttl: float, stale_ttl: float, max_size: int):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.inflight = {}
+
+    async def get(self, key, loader):
+        entry = self.entries.get(key)
+
+        if entry:
+            value, fetched_at = entry
+            age = time.monotonic() - fetched_at
+
+            if age < self.ttl:
+                self.entries.move_to_end(key)
+                CACHE_REQUESTS.labels(cache=self.name, result="hit").inc()
+                return value
+
+            if age < self.ttl + self.stale_ttl:
+                self.entries.move_to_end(key)
+                CACHE_REQUESTS.labels(cache=self.name, result="stale").inc()
+                self._fetch(key, loader)
+                return value
+
+        if key in self.inflight:
+            CACHE_REQUESTS.labels(cache=self.name, result="coalesced").inc()
+        else:
+            CACHE_REQUESTS.labels(cache=self.name, result="miss").inc()
+
+        # shield: a client disconnecting must not cancel the fetch the other waiters share
+        return await asyncio.shield(self._fetch(key, loader))
+
+    def _fetch(self, key, loader):
+        task = self.inflight.get(key)
+
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader))
+            task.add_done_callback(self._done)
+            self.inflight[key] = task
+
+        return task
+
+    async def _load(self, key, loader):
+        try:
+            # In the context of the request that started the load, its upstream span is a child of that request
+            value = await asyncio.get_running_loop().run_in_executor(upstream_pool, contextvars.copy_context().run, loader, key)
+            self._store(key, value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def _store(self, key, value):
+        self.entries[key] = (value, time.monotonic())
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            CACHE_EVICTIONS.labels(cache=self.name).inc()
+
+    @staticmethod
+    def _done(task):
+        # Failed background refreshes have no waiter, consume the exception so it isn't logged as unhandled
+        if not task.cancelled():
+            task.exception()
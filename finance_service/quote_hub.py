@@ -0,0 +1,102 @@
+import asyncio
+from collections import defaultdict
+
+
+class Subscription:
+    """
+    One streaming client. Updates are conflated: only the latest quote per
+    symbol is kept until the client reads it, so a slow consumer skips
+    intermediate quotes instead of growing a queue.
+    """
+
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.pending = {}
+        self.sent = {}
+        self.ready = asyncio.Event()
+
+    def push(self, symbol, quote: dict):
+        self.pending[symbol] = quote
+        self.ready.set()
+
+    async def next(self, timeout: float):
+        """Waits for updates, returns {symbol: changed fields} or None if nothing changed within timeout."""
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        self.ready.clear()
+        pending, self.pending = self.pending, {}
+        changes = {}
+
+        for symbol, quote in pending.items():
+            previous = self.sent.get(symbol)
+
+            if previous is None:
+                changed = quote
+            else:
+                changed = {field: value for field, value in quote.items() if previous.get(field) != value}
+
+            if changed:
+                changes[symbol] = changed
+                self.sent[symbol] = quote
+
+        return changes
+
+
+class QuoteHub:
+    """
+    Fans quotes out to streaming clients: one poller task per symbol that at
+    least one client is subscribed to, whatever the number of clients.
+    """
+
+    def __init__(self, loader, interval: float):
+        # loader(symbol) is a coroutine returning the quote as a dict, or None if there is none
+        self.loader = loader
+        self.interval = interval
+        self.subscribers = defaultdict(set)
+        self.pollers = {}
+        self.latest = {}
+
+    def subscribe(self, symbols) -> Subscription:
+        subscription = Subscription(symbols)
+
+        for symbol in symbols:
+            self.subscribers[symbol].add(subscription)
+
+            if symbol in self.latest:
+                subscription.push(symbol, self.latest[symbol])
+
+            if symbol not in self.pollers:
+                self.pollers[symbol] = asyncio.create_task(self._poll(symbol))
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for symbol in subscription.symbols:
+            self.subscribers[symbol].discard(subscription)
+
+            # Last subscriber gone, stop asking the upstream for this symbol
+            if not self.subscribers[symbol]:
+                del self.subscribers[symbol]
+                self.latest.pop(symbol, None)
+                self.pollers.pop(symbol).cancel()
+
+    async def _poll(self, symbol):
+        while True:
+            try:
+                quote = await self.loader(symbol)
+
+                if quote is not None and quote != self.latest.get(symbol):
+                    self.latest[symbol] = quote
+
+                    for subscription in self.subscribers.get(symbol, ()):
+                        subscription.push(symbol, quote)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[finance/stream] Error polling {symbol}: {e}")
+
+            await asyncio.sleep(self.interval)
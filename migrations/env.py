@@ -0,0 +1,44 @@
+from logging.config import fileConfig
+from alembic import context
+import os
+
+from shared.models import SCHEMA_REVISION, Base
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+# The services wait for SCHEMA_REVISION, a new migration without the bump would let them start too early
+if context.script.get_current_head() != SCHEMA_REVISION:
+    raise RuntimeError(f"Alembic head is {context.script.get_current_head()}, shared/models.py SCHEMA_REVISION is {SCHEMA_REVISION}")
+
+
+def run_migrations_offline():
+    context.configure(
+        url=os.getenv("MAIN_DB_URL"),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    from shared.database import engine
+
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,56 @@
+"""Baseline schema, as created by init_main_db.sql
+
+Revision ID: 0001
+Revises:
+Create Date: 2025-05-02
+"""
+from alembic import op
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # IF NOT EXISTS: databases initialised by init_main_db.sql already have these tables
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            balance NUMERIC(12, 2) DEFAULT 0.00,
+            added_balance NUMERIC(12, 2) DEFAULT 0.00
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS portfolio (
+            id SERIAL PRIMARY KEY,
+            username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+            symbol TEXT NOT NULL,
+            quantity INT NOT NULL CHECK (quantity >= 0),
+            price NUMERIC(12, 2) NOT NULL CHECK (price >= 0)
+        )
+    """)
+
+    op.execute("""
+        CREATE TABLE IF NOT EXISTS trades (
+            id SERIAL PRIMARY KEY,
+            username TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            quantity INT NOT NULL,
+            price FLOAT NOT NULL,
+            action TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            flag TEXT DEFAULT 'unprocessed',
+            portfolio_price NUMERIC(12, 2) DEFAULT -1.0
+        )
+    """)
+
+
+def downgrade():
+    op.execute("DROP TABLE IF EXISTS trades")
+    op.execute("DROP TABLE IF EXISTS portfolio")
+    op.execute("DROP TABLE IF EXISTS users")
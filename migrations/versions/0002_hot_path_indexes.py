@@ -0,0 +1,53 @@
+"""Indexes for the matcher and the portfolio lookups
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2025-05-02
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Open orders only, the matcher loads them per symbol and side in price-time order
+    op.create_index(
+        "ix_trades_open_orders",
+        "trades",
+        ["symbol", "action", "price", "created_at"],
+        postgresql_where=sa.text("flag = 'unprocessed'"),
+    )
+
+    # Merge duplicate holdings before making (username, symbol) unique
+    op.execute("""
+        WITH merged AS (
+            SELECT username, symbol, MIN(id) AS keep_id, SUM(quantity) AS quantity,
+                   CASE WHEN SUM(quantity) > 0 THEN SUM(price * quantity) / SUM(quantity) ELSE MAX(price) END AS price
+            FROM portfolio
+            GROUP BY username, symbol
+            HAVING COUNT(*) > 1
+        ),
+        kept AS (
+            UPDATE portfolio
+            SET quantity = merged.quantity, price = merged.price
+            FROM merged
+            WHERE portfolio.id = merged.keep_id
+        )
+        DELETE FROM portfolio
+        USING merged
+        WHERE portfolio.username = merged.username
+          AND portfolio.symbol = merged.symbol
+          AND portfolio.id <> merged.keep_id
+    """)
+
+    op.create_unique_constraint("uq_portfolio_username_symbol", "portfolio", ["username", "symbol"])
+
+
+def downgrade():
+    op.drop_constraint("uq_portfolio_username_symbol", "portfolio", type_="unique")
+    op.drop_index("ix_trades_open_orders", table_name="trades")
@@ -0,0 +1,22 @@
+"""Index for the per-user trade history
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2025-05-09
+"""
+from alembic import op
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # /get_trades and /export_trades walk a user's trades in (created_at, id) order from a keyset cursor
+    op.create_index("ix_trades_username_created_at_id", "trades", ["username", "created_at", "id"])
+
+
+def downgrade():
+    op.drop_index("ix_trades_username_created_at_id", table_name="trades")
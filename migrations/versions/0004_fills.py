@@ -0,0 +1,41 @@
+"""Fills written by the matcher
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2025-05-12
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # One row per match. Executed trades end with quantity 0, the fills keep what was traded, at which
+    # price and, for the seller, the average price the shares were held at (the sell order's portfolio_price)
+    op.create_table(
+        "fills",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("buy_trade_id", sa.Integer, nullable=False),
+        sa.Column("sell_trade_id", sa.Integer, nullable=False),
+        sa.Column("symbol", sa.String, nullable=False),
+        sa.Column("quantity", sa.Integer, nullable=False),
+        sa.Column("price", sa.Numeric(12, 2), nullable=False),
+        sa.Column("buyer", sa.String, nullable=False),
+        sa.Column("seller", sa.String, nullable=False),
+        sa.Column("cost_basis", sa.Numeric(12, 2), nullable=False),
+        sa.Column("executed_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+
+    op.create_index("ix_fills_seller_symbol", "fills", ["seller", "symbol"])
+    op.create_index("ix_fills_symbol_executed_at", "fills", ["symbol", "executed_at"])
+
+
+def downgrade():
+    op.drop_index("ix_fills_symbol_executed_at", table_name="fills")
+    op.drop_index("ix_fills_seller_symbol", table_name="fills")
+    op.drop_table("fills")
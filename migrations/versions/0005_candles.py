@@ -0,0 +1,55 @@
+"""OHLCV candles rolled up from the fills
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2025-05-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+# Same buckets as business_logic_service/candles.py, aligned to UTC
+INTERVALS = [("1m", "1 minute"), ("5m", "5 minutes"), ("1h", "1 hour"), ("1d", "1 day")]
+
+
+def upgrade():
+    # The primary key doubles as the index of the chart queries: one symbol and interval, a range of buckets
+    op.create_table(
+        "candles",
+        sa.Column("symbol", sa.String, primary_key=True),
+        sa.Column("interval", sa.String, primary_key=True),
+        sa.Column("bucket_start", sa.DateTime(timezone=True), primary_key=True),
+        sa.Column("open", sa.Numeric(12, 2), nullable=False),
+        sa.Column("high", sa.Numeric(12, 2), nullable=False),
+        sa.Column("low", sa.Numeric(12, 2), nullable=False),
+        sa.Column("close", sa.Numeric(12, 2), nullable=False),
+        sa.Column("volume", sa.BigInteger, nullable=False),
+        sa.Column("trade_count", sa.Integer, nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    )
+
+    # Candles of the fills settled before the matcher kept them up to date
+    for interval, step in INTERVALS:
+        op.execute(sa.text(f"""
+            INSERT INTO candles (symbol, interval, bucket_start, open, high, low, close, volume, trade_count)
+            SELECT symbol,
+                   '{interval}',
+                   date_bin(INTERVAL '{step}', executed_at, TIMESTAMPTZ '2000-01-01 00:00:00+00'),
+                   (array_agg(price ORDER BY executed_at, id))[1],
+                   max(price),
+                   min(price),
+                   (array_agg(price ORDER BY executed_at DESC, id DESC))[1],
+                   sum(quantity),
+                   count(*)
+            FROM fills
+            GROUP BY symbol, 3
+        """))
+
+
+def downgrade():
+    op.drop_table("candles")
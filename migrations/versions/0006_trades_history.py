@@ -0,0 +1,32 @@
+"""Cold table for executed trades
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2025-05-23
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Same columns as trades, without the id sequence: archived rows keep the id they had.
+    # The executed rows already in trades are moved by the archiver in batches, not here
+    op.execute("CREATE TABLE trades_history (LIKE trades INCLUDING DEFAULTS)")
+    op.execute("ALTER TABLE trades_history ALTER COLUMN id DROP DEFAULT")
+    op.create_primary_key("trades_history_pkey", "trades_history", ["id"])
+    op.create_index("ix_trades_history_username_created_at_id", "trades_history", ["username", "created_at", "id"])
+
+    # What the archiver picks up: small, its rows leave the table as soon as they are moved
+    op.create_index("ix_trades_archivable", "trades", ["id"], postgresql_where=sa.text("flag <> 'unprocessed'"))
+
+
+def downgrade():
+    op.execute("INSERT INTO trades SELECT * FROM trades_history ON CONFLICT (id) DO NOTHING")
+    op.drop_index("ix_trades_archivable", table_name="trades")
+    op.drop_table("trades_history")
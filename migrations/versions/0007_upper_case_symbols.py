@@ -0,0 +1,78 @@
+"""Upper-case the symbols written before they were normalized
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2025-05-26
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+# Same buckets as business_logic_service/candles.py, aligned to UTC
+INTERVALS = [("1m", "1 minute"), ("5m", "5 minutes"), ("1h", "1 hour"), ("1d", "1 day")]
+
+# shared.schemas.normalize_symbol
+NORMALIZED = "upper(btrim(symbol))"
+
+
+def upgrade():
+    # Symbols whose candles are rebuilt: the ones that had fills under another spelling
+    op.execute(f"""
+        CREATE TEMPORARY TABLE renamed_symbols ON COMMIT DROP AS
+        SELECT DISTINCT {NORMALIZED} AS symbol FROM fills WHERE symbol <> {NORMALIZED}
+    """)
+
+    for table in ("trades", "trades_history", "fills"):
+        op.execute(f"UPDATE {table} SET symbol = {NORMALIZED} WHERE symbol <> {NORMALIZED}")
+
+    # Holdings of "aapl" and "AAPL" become one, merged into the oldest row before renaming
+    op.execute(f"""
+        WITH merged AS (
+            SELECT username, {NORMALIZED} AS symbol, MIN(id) AS keep_id, SUM(quantity) AS quantity,
+                   CASE WHEN SUM(quantity) > 0 THEN SUM(price * quantity) / SUM(quantity) ELSE MAX(price) END AS price
+            FROM portfolio
+            GROUP BY username, {NORMALIZED}
+            HAVING COUNT(*) > 1
+        ),
+        kept AS (
+            UPDATE portfolio
+            SET quantity = merged.quantity, price = merged.price
+            FROM merged
+            WHERE portfolio.id = merged.keep_id
+        )
+        DELETE FROM portfolio
+        USING merged
+        WHERE portfolio.username = merged.username
+          AND upper(btrim(portfolio.symbol)) = merged.symbol
+          AND portfolio.id <> merged.keep_id
+    """)
+    op.execute(f"UPDATE portfolio SET symbol = {NORMALIZED} WHERE symbol <> {NORMALIZED}")
+
+    op.execute(f"DELETE FROM candles WHERE {NORMALIZED} IN (SELECT symbol FROM renamed_symbols)")
+
+    for interval, step in INTERVALS:
+        op.execute(sa.text(f"""
+            INSERT INTO candles (symbol, interval, bucket_start, open, high, low, close, volume, trade_count)
+            SELECT symbol,
+                   '{interval}',
+                   date_bin(INTERVAL '{step}', executed_at, TIMESTAMPTZ '2000-01-01 00:00:00+00'),
+                   (array_agg(price ORDER BY executed_at, id))[1],
+                   max(price),
+                   min(price),
+                   (array_agg(price ORDER BY executed_at DESC, id DESC))[1],
+                   sum(quantity),
+                   count(*)
+            FROM fills
+            WHERE symbol IN (SELECT symbol FROM renamed_symbols)
+            GROUP BY symbol, 3
+        """))
+
+
+def downgrade():
+    # The original spelling isn't kept, upper-case symbols are valid for the old code too
+    pass
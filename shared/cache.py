@@ -0,0 +1,202 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from prometheus_client import Counter
+
+from shared.events import CACHE_INVALIDATION_CHANNEL, transport
+
+# "memory" (per process LRU), "redis" (shared between replicas) or "none"
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Entries are invalidated by the writers, the TTL only bounds how long a lost invalidation can last
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+RECONNECT_DELAY = 3 # seconds
+
+USER_CACHE_REQUESTS = Counter(
+    'user_cache_requests_total',
+    'Per-user cache lookups by kind (balance, portfolio) and result (hit, miss, error)',
+    ['kind', 'result']
+)
+
+
+class MemoryBackend:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # Users by last bump, bounded like the entries: an evicted user's generation is covered by the floor
+        self.generations = OrderedDict()
+        # Generations come from one counter so a user's generation never goes back to a value already used
+        self.counter = itertools.count(1)
+        self.floor = 0
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value, ttl):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def generation(self, username):
+        return max(self.generations.get(username, 0), self.floor)
+
+    async def bump(self, username):
+        self.generations[username] = next(self.counter)
+        self.generations.move_to_end(username)
+
+        while len(self.generations) > self.max_size:
+            # The oldest bump, every user still below it moves up to it (and misses once)
+            _, generation = self.generations.popitem(last=False)
+            self.floor = max(self.floor, generation)
+
+    async def reset(self):
+        # Every user moves past the generation of the entries cached so far
+        self.floor = next(self.counter)
+        self.generations.clear()
+        self.entries.clear()
+
+
+class RedisBackend:
+
+    def __init__(self, url: str):
+        # Optional dependency, only needed with CACHE_BACKEND=redis
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+
+    async def get(self, key):
+        return await self.client.get(key)
+
+    async def set(self, key, value, ttl):
+        await self.client.set(key, value, px=int(ttl * 1000))
+
+    async def generation(self, username):
+        return int(await self.client.get(f"generation:{username}") or 0)
+
+    async def bump(self, username):
+        await self.client.incr(f"generation:{username}")
+
+    async def reset(self):
+        # Shared by all the replicas, the writers bumped it even while this one wasn't listening
+        pass
+
+
+class UserCache:
+    """
+    Read-through cache of per-user responses (balance, portfolio).
+
+    Entries are keyed by the user's generation, which every write path bumps
+    after its commit. The generation is read before the database, so a read
+    racing with a write can only store its result under the old generation.
+    """
+
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def get(self, kind: str, username: str, loader):
+        if self.backend is None:
+            return await loader()
+
+        try:
+            generation = await self.backend.generation(username)
+            key = f"{kind}:{username}:{generation}"
+            cached = await self.backend.get(key)
+        except Exception as e:
+            # The database is still there, a broken cache only costs the query
+            print(f"[cache] Lookup failed: {e}")
+            USER_CACHE_REQUESTS.labels(kind=kind, result="error").inc()
+            return await loader()
+
+        if cached is not None:
+            USER_CACHE_REQUESTS.labels(kind=kind, result="hit").inc()
+            return json.loads(cached)
+
+        USER_CACHE_REQUESTS.labels(kind=kind, result="miss").inc()
+        value = await loader()
+
+        try:
+            await self.backend.set(key, json.dumps(value), self.ttl)
+        except Exception as e:
+            print(f"[cache] Store failed: {e}")
+
+        return value
+
+    async def invalidate(self, username: str):
+        if self.backend is None:
+            return
+
+        try:
+            await self.backend.bump(username)
+        except Exception as e:
+            print(f"[cache] Invalidation of {username} failed: {e}")
+
+    async def reset(self):
+        if self.backend is not None:
+            await self.backend.reset()
+
+
+def create_user_cache() -> UserCache:
+    if CACHE_BACKEND == "none":
+        return UserCache(None, CACHE_TTL)
+
+    if CACHE_BACKEND == "redis":
+        return UserCache(RedisBackend(REDIS_URL), CACHE_TTL)
+
+    return UserCache(MemoryBackend(CACHE_MAX_SIZE), CACHE_TTL)
+
+
+def start_invalidation_listener(cache: UserCache, loop: asyncio.AbstractEventLoop):
+    """
+    Applies the invalidations published by other processes (the other replicas,
+    the matcher) to this process' cache. Runs in a thread, the cache itself is
+    only touched from the event loop.
+    """
+
+    def run():
+        while True:
+            listener = None
+
+            try:
+                listener = transport.listen(CACHE_INVALIDATION_CHANNEL)
+
+                # Whatever was published while not listening is lost, start over
+                asyncio.run_coroutine_threadsafe(cache.reset(), loop).result()
+
+                while True:
+                    for channel, username in listener.wait(60):
+                        asyncio.run_coroutine_threadsafe(cache.invalidate(username), loop)
+
+            except Exception as e:
+                print(f"[cache] Invalidation listener failed, reconnecting: {e}")
+                time.sleep(RECONNECT_DELAY)
+
+            finally:
+                if listener:
+                    listener.close()
+
+    thread = threading.Thread(target=run, name="cache-invalidation", daemon=True)
+    thread.start()
+
+    return thread
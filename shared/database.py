@@ -1,11 +1,279 @@
-from sqlalchemy import create_engine
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+import functools
+import hashlib
 import os
+import re
+import time
+
+from shared.models import SCHEMA_REVISION
+from shared.tracing import trace_engine
 
 MAIN_DB_URL = os.getenv("MAIN_DB_URL")
 
 if not MAIN_DB_URL:
     raise ValueError("MAIN_DB_URL environment variable is not set")
 
+# Connection pool of the async engine, a request only holds a connection while a query runs
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Connections opened by the warm-up, the rest is still opened on demand. Every replica
+# holds them, replicas x DB_POOL_WARM_UP has to stay well below max_connections
+DB_POOL_WARM_UP = int(os.getenv("DB_POOL_WARM_UP", "5"))
+SCHEMA_RETRY_DELAY = 3 # seconds
+
+# Query profiler (opt-in): statements and database time per unit of work (a request, a match cycle),
+# a warning when one normalized statement runs more than DB_PROFILE_REPEAT_THRESHOLD times in a unit
+DB_PROFILING = os.getenv("DB_PROFILING", "false").lower() == "true"
+DB_PROFILE_REPEAT_THRESHOLD = int(os.getenv("DB_PROFILE_REPEAT_THRESHOLD", "10"))
+DB_PROFILE_TOP = int(os.getenv("DB_PROFILE_TOP", "3")) # slowest statements of a unit exported per unit
+
 engine = create_engine(MAIN_DB_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# The async engine (SQLAlchemy asyncio + asyncpg) is created on first use,
+# services that only use the sync engine don't need asyncpg installed
+async_engine = None
+_async_sessionmaker = None
+
+
+def get_async_engine():
+    global async_engine
+
+    if async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        async_engine = create_async_engine(
+            make_url(MAIN_DB_URL).set(drivername="postgresql+asyncpg"),
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+        )
+
+        if DB_PROFILING:
+            profile_engine(async_engine.sync_engine)
+
+        trace_engine(async_engine.sync_engine)
+
+    return async_engine
+
+
+def AsyncSessionLocal():
+    global _async_sessionmaker
+
+    if _async_sessionmaker is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+
+        _async_sessionmaker = async_sessionmaker(get_async_engine(), autoflush=False, expire_on_commit=False)
+
+    return _async_sessionmaker()
+
+
+async def warm_up_pool():
+    """Opens DB_POOL_WARM_UP connections of the async pool, the first requests of a replica don't wait for a connect."""
+    from sqlalchemy.orm import configure_mappers
+
+    configure_mappers()
+    connections = [get_async_engine().connect() for _ in range(min(DB_POOL_WARM_UP, DB_POOL_SIZE))]
+
+    try:
+        # All checked out at once, so each one is a new connection
+        await asyncio.gather(*(connection.start() for connection in connections))
+    finally:
+        await asyncio.gather(*(connection.close() for connection in connections if connection.sync_connection))
+
+
+class SchemaNotReadyError(Exception):
+    pass
+
+
+def _require_schema(revision):
+    # Revisions are numbered, a newer schema (the migrations of a rolling update) is fine
+    if revision is None or int(revision) < int(SCHEMA_REVISION):
+        raise SchemaNotReadyError(f"Database schema at revision {revision}, waiting for the migrations to {SCHEMA_REVISION}")
+
+
+async def check_schema():
+    """Readiness step: fails until the migrations brought main_db to SCHEMA_REVISION."""
+    async with get_async_engine().connect() as connection:
+        _require_schema((await connection.execute(text("SELECT version_num FROM alembic_version"))).scalar())
+
+
+def wait_for_schema(service: str):
+    """Blocks until the migrations brought main_db to SCHEMA_REVISION, for processes without a readiness probe."""
+    while True:
+        try:
+            with engine.connect() as connection:
+                _require_schema(connection.execute(text("SELECT version_num FROM alembic_version")).scalar())
+            return
+        except Exception as e:
+            print(f"[{service}] Schema not ready, retrying: {e}")
+            time.sleep(SCHEMA_RETRY_DELAY)
+
+
+# Query profiler
+_current_unit = ContextVar("db_profile_unit", default=None)
+_profile_metrics = None
+
+BIND_PARAMETER = re.compile(r"%\(\w+\)s|\$\d+|(?<![:\w]):\w+|\?")
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+REPEATED_TUPLES = re.compile(r"(\((?:[^()]|\([^()]*\))*\))(?:\s*,\s*\1)+")
+WHITESPACE = re.compile(r"\s+")
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+\"?(\w+)", re.IGNORECASE)
+
+
+# The raw text varies with the length of IN and VALUES lists, keep the cache bounded.
+# lru_cache is thread-safe, the sync engine records from the threadpool
+@functools.lru_cache(maxsize=2000)
+def normalize_statement(statement: str) -> str:
+    """Parameters and literals become ?, lists and VALUES rows of any length collapse into one."""
+    normalized = WHITESPACE.sub(" ", statement).strip()
+    normalized = LITERAL.sub("?", BIND_PARAMETER.sub("?", normalized))
+    normalized = PARAMETER_LIST.sub("(?, ...)", normalized)
+    return REPEATED_TUPLES.sub(r"\1, ...", normalized)
+
+
+@functools.lru_cache(maxsize=2000)
+def statement_fingerprint(normalized: str) -> str:
+    """Short metric label of a normalized statement: verb, first table and a hash, e.g. "UPDATE trades 1a2b3c4d"."""
+    table = STATEMENT_TABLE.search(normalized)
+    fingerprint = " ".join(filter(None, [normalized.split(" ", 1)[0].upper(),
+                                         table and table.group(1),
+                                         hashlib.sha1(normalized.encode()).hexdigest()[:8]]))
+
+    # Only the label is exported, the log maps it back to the statement
+    print(f"[db_profile] Statement {fingerprint}: {normalized}")
+
+    return fingerprint
+
+
+def profile_metrics():
+    global _profile_metrics
+
+    if _profile_metrics is None:
+        # Only needed with DB_PROFILING, not every user of this module has prometheus_client
+        from prometheus_client import Histogram
+
+        _profile_metrics = (
+            Histogram(
+                'db_profile_statements_per_unit',
+                'Statements executed per unit of work (request, match cycle)',
+                ['unit'],
+                buckets=(1, 2, 3, 5, 10, 20, 50, 100, 250, 1000)
+            ),
+            Histogram(
+                'db_profile_unit_db_seconds',
+                'Database time per unit of work in seconds',
+                ['unit']
+            ),
+            Histogram(
+                'db_profile_statement_seconds',
+                'Total time of each of the slowest normalized statements of a unit of work in seconds, by statement fingerprint',
+                ['unit', 'statement']
+            ),
+        )
+
+    return _profile_metrics
+
+
+class UnitOfWork:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.statements = 0
+        self.db_time = 0.0
+        # normalized statement -> [executions, total seconds]
+        self.by_statement = {}
+
+    def record(self, statement: str, elapsed: float):
+        self.statements += 1
+        self.db_time += elapsed
+
+        stats = self.by_statement.get(statement)
+
+        if stats is None:
+            self.by_statement[statement] = [1, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+
+    def finish(self):
+        if not self.statements:
+            return
+
+        statements_per_unit, unit_db_time, statement_time = profile_metrics()
+        statements_per_unit.labels(unit=self.name).observe(self.statements)
+        unit_db_time.labels(unit=self.name).observe(self.db_time)
+
+        slowest = sorted(self.by_statement.items(), key=lambda item: item[1][1], reverse=True)[:DB_PROFILE_TOP]
+
+        for statement, (_, total) in slowest:
+            statement_time.labels(unit=self.name, statement=statement_fingerprint(statement)).observe(total)
+
+        for statement, (executions, total) in self.by_statement.items():
+            if executions > DB_PROFILE_REPEAT_THRESHOLD:
+                print(f"[db_profile] Warning: {self.name} ran the same statement {executions} times "
+                      f"({total * 1000:.1f} ms), N+1?: {statement_fingerprint(statement)}: {statement}")
+
+
+@contextmanager
+def profile_unit(name: str):
+    """
+    Statements run inside the block (in this thread or asyncio task) are counted
+    for one unit of work. unit.name can still be changed before the block ends,
+    e.g. to the route template once the request was routed. A no-op unless DB_PROFILING.
+    """
+    if not DB_PROFILING:
+        yield None
+        return
+
+    unit = UnitOfWork(name)
+    token = _current_unit.set(unit)
+
+    try:
+        yield unit
+    finally:
+        _current_unit.reset(token)
+        unit.finish()
+
+
+class QueryProfilerMiddleware:
+    """ASGI middleware making every HTTP request a unit of work, named by method and route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not DB_PROFILING or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        with profile_unit(scope["method"]) as unit:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                # The router stored the matched route in the scope on the way in
+                route = scope.get("route")
+                unit.name = f"{scope['method']} {getattr(route, 'path', None) or '<unmatched>'}"
+
+
+def profile_engine(target):
+    @event.listens_for(target, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        context._profile_started = time.perf_counter()
+
+    @event.listens_for(target, "after_cursor_execute")
+    def record(conn, cursor, statement, parameters, context, executemany):
+        unit = _current_unit.get()
+
+        if unit is not None:
+            unit.record(normalize_statement(statement), time.perf_counter() - context._profile_started)
+
+
+if DB_PROFILING:
+    profile_engine(engine)
+
+trace_engine(engine)
@@ -0,0 +1,174 @@
+import os
+import queue
+import select
+from collections import defaultdict
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from shared.schemas import OrderEvent
+from shared.tracing import current_traceparent
+
+ORDER_EVENTS_CHANNEL = "order_events"
+CACHE_INVALIDATION_CHANNEL = "cache_invalidation"
+# Sent by a matcher worker that gave shards back, the others claim them without waiting for their reconcile
+SHARD_REBALANCE_CHANNEL = "shard_rebalance"
+
+# "postgres" (LISTEN/NOTIFY) in the deployed stack, "memory" for tests and single-process runs
+EVENTS_TRANSPORT = os.getenv("EVENTS_TRANSPORT", "postgres")
+
+
+class PostgresTransport:
+    """
+    Events are sent with pg_notify() inside the writer's own transaction, so
+    listeners only see them once (and if) the transaction commits.
+    """
+
+    def before_commit(self, session: Session, pending):
+        channels = defaultdict(list)
+
+        for channel, payload in pending:
+            channels[channel].append(payload)
+
+        for channel, payloads in channels.items():
+            session.execute(
+                text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS TEXT[])) AS payload"),
+                {"channel": channel, "payloads": payloads}
+            )
+
+    def after_commit(self, pending):
+        pass
+
+    def listen(self, *channels):
+        return PostgresListener(channels)
+
+
+class PostgresListener:
+
+    def __init__(self, channels):
+        # Imported here so services that only publish don't create an engine for nothing
+        from shared.database import engine
+
+        self.channels = channels
+        # Dedicated connection, taken out of the pool for the lifetime of the listener
+        self.raw = engine.raw_connection()
+        self.conn = self.raw.driver_connection
+        self.raw.detach()
+
+        self.conn.autocommit = True
+
+        with self.conn.cursor() as cursor:
+            for channel in channels:
+                cursor.execute(f'LISTEN "{channel}"')
+
+    def wait(self, timeout):
+        if not self.conn.notifies and select.select([self.conn], [], [], timeout) == ([], [], []):
+            return []
+
+        self.conn.poll()
+        notifies = list(self.conn.notifies)
+        self.conn.notifies.clear()
+
+        return [(notify.channel, notify.payload) for notify in notifies]
+
+    def close(self):
+        self.raw.close()
+
+
+class InProcessTransport:
+    """
+    Events go to the listeners of this process once the writer's transaction
+    committed. Like LISTEN, a listener only gets what was sent after it started.
+    """
+
+    def __init__(self):
+        self.listeners = defaultdict(list)
+
+    def before_commit(self, session: Session, pending):
+        pass
+
+    def after_commit(self, pending):
+        for channel, payload in pending:
+            for listener in list(self.listeners[channel]):
+                listener.queue.put((channel, payload))
+
+    def listen(self, *channels):
+        listener = InProcessListener(self, channels)
+
+        for channel in channels:
+            self.listeners[channel].append(listener)
+
+        return listener
+
+
+class InProcessListener:
+
+    def __init__(self, transport, channels):
+        self.transport = transport
+        self.channels = channels
+        # One queue for all the channels, a wait wakes up on any of them
+        self.queue = queue.Queue()
+
+    def wait(self, timeout):
+        try:
+            messages = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while not self.queue.empty():
+            messages.append(self.queue.get_nowait())
+
+        return messages
+
+    def close(self):
+        for channel in self.channels:
+            self.transport.listeners[channel].remove(self)
+
+
+TRANSPORTS = {
+    "postgres": PostgresTransport,
+    "memory": InProcessTransport,
+}
+
+transport = TRANSPORTS[EVENTS_TRANSPORT]()
+
+
+def publish(session: Session, channel: str, payload: str):
+    session.info.setdefault("pending_events", []).append((channel, payload))
+
+
+def publish_order_event(session: Session, order_event: OrderEvent):
+    if order_event.traceparent is None:
+        order_event.traceparent = current_traceparent()
+
+    publish(session, ORDER_EVENTS_CHANNEL, order_event.model_dump_json())
+
+
+def publish_cache_invalidation(session: Session, username: str):
+    # Cached balance/portfolio of this user is outdated once the transaction commits
+    publish(session, CACHE_INVALIDATION_CHANNEL, username)
+
+
+def parse_order_events(messages):
+    return [OrderEvent.model_validate_json(payload) for channel, payload in messages
+            if channel == ORDER_EVENTS_CHANNEL]
+
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session):
+    pending = session.info.get("pending_events")
+
+    if pending:
+        transport.before_commit(session, pending)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    pending = session.info.pop("pending_events", None)
+
+    if pending:
+        transport.after_commit(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("pending_events", None)
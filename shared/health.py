@@ -0,0 +1,68 @@
+import asyncio
+import os
+import time
+from starlette.responses import JSONResponse
+
+# Warm-up on startup (pool, lazy imports, caches) before /readyz says the replica can take traffic
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+WARM_UP_RETRY_DELAY = float(os.getenv("WARM_UP_RETRY_DELAY", "2")) # seconds
+
+
+def add_health_endpoints(app, service: str, *steps, requires=()):
+    """
+    Adds the probes of a replica:
+
+      /healthz  200 as long as the process and its event loop answer (liveness)
+      /readyz   503 until every warm-up step succeeded, then 200 (readiness)
+
+    The steps are async callables run in order in the background on startup, so
+    /healthz answers right away; a failing step (e.g. the database not up yet)
+    is retried every WARM_UP_RETRY_DELAY seconds. The Docker healthcheck polls
+    /healthz, a replica that can't reach the database for a while is not
+    restarted for it; /readyz is for a load balancer or gateway deciding where
+    to route.
+
+    The requires steps (e.g. the schema being migrated) run first and also with
+    WARM_UP=false, the replica is never ready without them.
+    """
+    steps = [*requires, *steps] if WARM_UP else list(requires)
+    state = {"ready": False, "pending": [step.__name__ for step in steps], "warm_up_seconds": None}
+
+    async def warm_up():
+        started = time.perf_counter()
+
+        for step in steps:
+            while True:
+                try:
+                    await step()
+                    break
+                except Exception as e:
+                    print(f"[{service}/warm_up] {step.__name__} failed, retrying: {e}")
+                    await asyncio.sleep(WARM_UP_RETRY_DELAY)
+
+            state["pending"].remove(step.__name__)
+
+        state["warm_up_seconds"] = round(time.perf_counter() - started, 3)
+        state["ready"] = True
+
+        print(f"[{service}/warm_up] Ready after {state['warm_up_seconds']}s")
+
+    @app.on_event("startup")
+    async def start_warm_up():
+        if steps:
+            # Kept on the state, the event loop only holds a weak reference to a task
+            state["task"] = asyncio.create_task(warm_up())
+        else:
+            state["pending"] = []
+            state["ready"] = True
+
+    @app.get("/healthz", include_in_schema=False)
+    async def healthz():
+        return {"status": "ok"}
+
+    @app.get("/readyz", include_in_schema=False)
+    async def readyz():
+        if not state["ready"]:
+            return JSONResponse({"status": "warming up", "pending": state["pending"]}, status_code=503)
+
+        return {"status": "ready", "warm_up_seconds": state["warm_up_seconds"]}
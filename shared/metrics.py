@@ -0,0 +1,109 @@
+import time
+from prometheus_client import Counter, Gauge, Histogram
+
+# Requests that matched no route (404s, scanners) share one label value instead of one per path
+UNMATCHED_ROUTE = "<unmatched>"
+
+RESPONSE_SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# One set of metrics per service name, Starlette may build the middleware stack more than once
+service_metrics = {}
+
+
+def http_metrics(service: str):
+    if service not in service_metrics:
+        # Same names as the per-service middleware this replaced, the dashboards keep working
+        service_metrics[service] = (
+            Counter(
+                f'{service}_requests_total',
+                'Total number of requests',
+                ['method', 'endpoint', 'status']
+            ),
+            Histogram(
+                f'{service}_request_latency_seconds',
+                'Request latency in seconds',
+                ['method', 'endpoint']
+            ),
+            Histogram(
+                f'{service}_response_size_bytes',
+                'Response body size in bytes',
+                ['method', 'endpoint'],
+                buckets=RESPONSE_SIZE_BUCKETS
+            ),
+            Gauge(
+                f'{service}_requests_in_progress',
+                'Requests being handled (streaming responses until their last chunk)',
+                ['method']
+            ),
+        )
+
+    return service_metrics[service]
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording, per service:
+
+      <service>_requests_total{method, endpoint, status}
+      <service>_request_latency_seconds{method, endpoint}
+      <service>_response_size_bytes{method, endpoint}
+      <service>_requests_in_progress{method}
+
+    The endpoint label is the route template (/edit_trade/{trade_id}), read
+    from the scope once the router has matched it, so the number of series is
+    bounded by the number of routes. The latency runs until the last body
+    chunk is sent, for a stream that is its whole lifetime.
+
+        app.add_middleware(MetricsMiddleware, service="auth_service")
+    """
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.requests, self.latency, self.response_size, self.in_progress = http_metrics(service)
+
+        # Label children by label values, .labels() takes a lock and validates on every call
+        self.children = {}
+
+    def child(self, metric, *labels):
+        key = (id(metric), labels)
+        child = self.children.get(key)
+
+        if child is None:
+            child = self.children[key] = metric.labels(*labels)
+
+        return child
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        started = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+
+            await send(message)
+
+        in_progress = self.child(self.in_progress, method)
+        in_progress.inc()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_progress.dec()
+
+            # The router stored the matched route in the scope on the way in
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or UNMATCHED_ROUTE
+
+            self.child(self.requests, method, endpoint, str(status)).inc()
+            self.child(self.latency, method, endpoint).observe(time.perf_counter() - started)
+            self.child(self.response_size, method, endpoint).observe(size)
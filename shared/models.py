@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer, String, Numeric, Float, DateTime
+from sqlalchemy import BigInteger, Column, Integer, String, Numeric, Float, DateTime, Index, UniqueConstraint, func, text
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone
 
 Base = declarative_base()
 
+# Alembic head these models match, bumped with every migration in migrations/versions (migrations/env.py
+# checks it). The services wait until the database is at least at this revision before they start working
+SCHEMA_REVISION = "0007"
+
 class User(Base):
     __tablename__ = "users"
 
@@ -16,6 +20,9 @@ class User(Base):
 
 class Portfolio(Base):
     __tablename__ = "portfolio"
+    __table_args__ = (
+        UniqueConstraint("username", "symbol", name="uq_portfolio_username_symbol"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, nullable=False)
@@ -24,9 +31,7 @@ class Portfolio(Base):
     price = Column(Numeric(12, 2), nullable=False)  # Average price per share
 
 
-class Trade(Base):
-    __tablename__ = "trades"
-
+class TradeColumns:
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, nullable=False)
     symbol = Column(String, nullable=False)
@@ -35,4 +40,58 @@ class Trade(Base):
     action = Column(String, nullable=False)     # "buy" or "sell"
     created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     flag = Column(String, default="unprocessed") 
-    portfolio_price = Column(Numeric(12, 2), nullable=False)
\ No newline at end of file
+    portfolio_price = Column(Numeric(12, 2), nullable=False)
+
+
+class Trade(TradeColumns, Base):
+    # Hot table: open orders and the executed ones the archiver hasn't moved yet
+    __tablename__ = "trades"
+    __table_args__ = (
+        Index("ix_trades_open_orders", "symbol", "action", "price", "created_at",
+              postgresql_where=text("flag = 'unprocessed'")),
+        Index("ix_trades_username_created_at_id", "username", "created_at", "id"),
+        Index("ix_trades_archivable", "id", postgresql_where=text("flag <> 'unprocessed'")),
+    )
+
+
+class TradeHistory(TradeColumns, Base):
+    # Cold table: executed orders moved out of trades by business_logic_service/archiver.py, same ids
+    __tablename__ = "trades_history"
+    __table_args__ = (
+        Index("ix_trades_history_username_created_at_id", "username", "created_at", "id"),
+    )
+
+
+class Fill(Base):
+    __tablename__ = "fills"
+    __table_args__ = (
+        Index("ix_fills_seller_symbol", "seller", "symbol"),
+        Index("ix_fills_symbol_executed_at", "symbol", "executed_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    buy_trade_id = Column(Integer, nullable=False)
+    sell_trade_id = Column(Integer, nullable=False)
+    symbol = Column(String, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    price = Column(Numeric(12, 2), nullable=False)
+    buyer = Column(String, nullable=False)
+    seller = Column(String, nullable=False)
+    cost_basis = Column(Numeric(12, 2), nullable=False)  # Seller's average price of the shares sold
+    executed_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+class Candle(Base):
+    __tablename__ = "candles"
+
+    # Rolled up by the matcher from the fills, one row per symbol, interval ("1m", "5m", "1h", "1d") and bucket
+    symbol = Column(String, primary_key=True)
+    interval = Column(String, primary_key=True)
+    bucket_start = Column(DateTime(timezone=True), primary_key=True)
+    open = Column(Numeric(12, 2), nullable=False)
+    high = Column(Numeric(12, 2), nullable=False)
+    low = Column(Numeric(12, 2), nullable=False)
+    close = Column(Numeric(12, 2), nullable=False)
+    volume = Column(BigInteger, nullable=False)
+    trade_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
@@ -1,5 +1,12 @@
-from typing import Optional
-from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel, Field, field_validator
+
+
+def normalize_symbol(symbol: str) -> str:
+    # Symbols are stored upper-case, orders of "aapl" and "AAPL" are the same book
+    return symbol.strip().upper()
+
 
 # Pydantic Schemas
 class UserCreate(BaseModel):
@@ -14,17 +21,66 @@ class BalanceUpdate(BaseModel):
     amount: float
 
 class TradeItem(BaseModel):
+    symbol: str
+    # A negative buy would credit the balance it debits, rejected with 422 by /add_trade and /add_trades
+    quantity: int = Field(gt=0)
+    price: float = Field(gt=0)
+    action: str
+    flag: str = "unprocessed"
+
+    _normalize_symbol = field_validator("symbol")(normalize_symbol)
+
+class TradeBatch(BaseModel):
+    trades: List[TradeItem]
+    all_or_nothing: bool = False
+
+class TradeResult(BaseModel):
+    index: int
+    trade_id: Optional[int] = None
+    error: Optional[str] = None
+
+class TradeRecord(BaseModel):
+    id: int
     symbol: str
     quantity: int
     price: float
     action: str
-    flag: str = "unprocessed"
+    flag: str
+    created_at: datetime
+    portfolio_price: float
+
+class TradePage(BaseModel):
+    trades: List[TradeRecord]
+    next_cursor: Optional[str] = None
 
 class PortfolioItem(BaseModel):
     symbol: str
     quantity: int
     price: float
 
+class HoldingValuation(BaseModel):
+    symbol: str
+    quantity: int
+    average_price: float
+    current_price: Optional[float] = None
+    market_value: Optional[float] = None
+    cost_basis: Optional[float] = None
+    unrealized_pnl: Optional[float] = None
+    unrealized_pnl_percent: Optional[float] = None
+    weight: Optional[float] = None
+    day_change: Optional[float] = None
+    day_change_percent: Optional[float] = None
+    realized_pnl: float
+    error: Optional[str] = None
+
+class PortfolioValuation(BaseModel):
+    holdings: List[HoldingValuation]
+    market_value: float
+    cost_basis: float
+    unrealized_pnl: float
+    day_change: float
+    realized_pnl: float
+
 class TradeUpdate(BaseModel):
     price: float | None = None
     quantity: int | None = None
@@ -39,10 +95,38 @@ class StockData(BaseModel):
     pe_ratio: Optional[float] = None
     dividend_yield: Optional[float] = None
 
+class StockQuote(BaseModel):
+    symbol: str
+    data: Optional[StockData] = None
+    error: Optional[str] = None
+
 class HistoricalData(BaseModel):
     date: str
     open: float
     high: float
     low: float
     close: float
-    volume: int
\ No newline at end of file
+    volume: int
+
+class HistoricalDataColumnar(BaseModel):
+    date: List[str]
+    open: List[float]
+    high: List[float]
+    low: List[float]
+    close: List[float]
+    volume: List[int]
+
+class CandleRecord(BaseModel):
+    bucket_start: datetime
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: int
+    trade_count: int
+
+class OrderEvent(BaseModel):
+    action: str     # "add", "edit" or "delete"
+    trade_id: int
+    symbol: str
+    traceparent: Optional[str] = None   # trace of the request that changed the order, continued by the matcher
\ No newline at end of file
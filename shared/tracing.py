@@ -0,0 +1,229 @@
+import os
+import sys
+from contextlib import nullcontext
+
+# Where the spans go: "otlp" (OTEL_EXPORTER_OTLP_ENDPOINT, Jaeger in the stack), "file" (JSON lines
+# in TRACING_FILE), "console", "memory" (kept in memory_exporter, for tests) or "none"
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none")
+TRACING_FILE = os.getenv("TRACING_FILE", "spans.jsonl")
+
+# Optional dependency: without opentelemetry (e.g. the migrations image) every helper is a no-op
+try:
+    from opentelemetry import propagate, trace
+    from opentelemetry.trace import Link, SpanKind, Status, StatusCode
+except ImportError:
+    trace = None
+
+enabled = False
+memory_exporter = None
+
+SPAN_KINDS = {"server": "SERVER", "client": "CLIENT", "internal": "INTERNAL", "consumer": "CONSUMER"}
+
+
+def setup_tracing(service_name: str):
+    """Installs this process' tracer provider, once, before the service handles anything."""
+    global enabled, memory_exporter
+
+    if trace is None or TRACING_EXPORTER == "none":
+        return
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+
+    if TRACING_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+
+    elif TRACING_EXPORTER == "file":
+        spans_file = open(TRACING_FILE, "a")
+        exporter = ConsoleSpanExporter(out=spans_file, formatter=lambda span: span.to_json(indent=None) + "\n")
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+
+    elif TRACING_EXPORTER == "console":
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter(out=sys.stdout)))
+
+    elif TRACING_EXPORTER == "memory":
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+        memory_exporter = InMemorySpanExporter()
+        provider.add_span_processor(SimpleSpanProcessor(memory_exporter))
+
+    else:
+        raise ValueError(f"Unknown TRACING_EXPORTER {TRACING_EXPORTER}")
+
+    trace.set_tracer_provider(provider)
+    enabled = True
+
+    print(f"[tracing] {service_name} exports spans to {TRACING_EXPORTER}")
+
+
+def tracer():
+    return trace.get_tracer("trader_idp")
+
+
+def span(name: str, kind: str = "internal", attributes: dict = None, parent=None, links=None):
+    """Context manager of a span that becomes the current one, a no-op while tracing is off."""
+    if not enabled:
+        return nullcontext()
+
+    return tracer().start_as_current_span(name, context=parent, kind=getattr(SpanKind, SPAN_KINDS[kind]),
+                                          attributes=attributes, links=links)
+
+
+def current_traceparent():
+    """W3C traceparent of the current span, e.g. to put in an event consumed by another service."""
+    if not enabled:
+        return None
+
+    carrier = {}
+    propagate.inject(carrier)
+
+    return carrier.get("traceparent")
+
+
+def context_from_traceparent(traceparent: str):
+    return propagate.extract({"traceparent": traceparent})
+
+
+def links_to(traceparents):
+    """Links to the spans behind the given traceparents (ignoring missing ones), e.g. the orders of a batch."""
+    if not enabled:
+        return []
+
+    links = []
+
+    for traceparent in sorted({traceparent for traceparent in traceparents if traceparent}):
+        span_context = trace.get_current_span(context_from_traceparent(traceparent)).get_span_context()
+
+        if span_context.is_valid:
+            links.append(Link(span_context))
+
+    return links
+
+
+def mark_error(exception: Exception):
+    """Records a handled exception on the current span, e.g. a match cycle that failed and was rolled back."""
+    if enabled:
+        current = trace.get_current_span()
+        current.record_exception(exception)
+        current.set_status(Status(StatusCode.ERROR, str(exception)))
+
+
+def inject_headers(headers: dict = None) -> dict:
+    """Adds the trace context to the headers of an outgoing request."""
+    headers = {} if headers is None else headers
+
+    if enabled:
+        propagate.inject(headers)
+
+    return headers
+
+
+class TracingMiddleware:
+    """
+    Pure ASGI middleware: one server span per HTTP request, continuing the
+    trace of the incoming traceparent header (set by Kong or by the calling
+    service) and named by the route template once the router matched it.
+
+    FastAPI versions with native telemetry start the same span (plus spans for
+    the dependencies and the endpoint) once a tracer provider is set, the
+    middleware then leaves the request to them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not enabled or scope["type"] != "http" or getattr(scope.get("fastapi.telemetry"), "span", None):
+            return await self.app(scope, receive, send)
+
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        method = scope["method"]
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        with tracer().start_as_current_span(method, context=propagate.extract(headers), kind=SpanKind.SERVER,
+                                            attributes={"http.request.method": method, "url.path": scope["path"]}) as current:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+
+                if route:
+                    current.update_name(f"{method} {route}")
+                    current.set_attribute("http.route", route)
+
+                current.set_attribute("http.response.status_code", status)
+
+                if status >= 500:
+                    current.set_status(Status(StatusCode.ERROR))
+
+
+def trace_engine(target):
+    """A client span per statement and per session commit, parented to whatever span is current."""
+    if trace is None:
+        return
+
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    @event.listens_for(target, "before_cursor_execute")
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        if enabled:
+            operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+            context._trace_span = tracer().start_span(operation, kind=SpanKind.CLIENT, attributes={
+                "db.system": "postgresql",
+                "db.statement": statement[:2000],
+            })
+
+    @event.listens_for(target, "after_cursor_execute")
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        current = getattr(context, "_trace_span", None)
+
+        if current is not None:
+            current.end()
+
+    @event.listens_for(target, "handle_error")
+    def fail_statement(exception_context):
+        current = getattr(exception_context.execution_context, "_trace_span", None)
+
+        if current is not None:
+            current.record_exception(exception_context.original_exception)
+            current.set_status(Status(StatusCode.ERROR))
+            current.end()
+
+    if not getattr(Session, "_traced", False):
+        Session._traced = True
+
+        # From before the flush to the end of COMMIT, the pending events are sent in between
+        @event.listens_for(Session, "before_commit")
+        def start_commit(session):
+            if enabled:
+                session.info["trace_commit_span"] = tracer().start_span("COMMIT", kind=SpanKind.CLIENT,
+                                                                        attributes={"db.system": "postgresql"})
+
+        @event.listens_for(Session, "after_commit")
+        def end_commit(session):
+            current = session.info.pop("trace_commit_span", None)
+
+            if current is not None:
+                current.end()
+
+        @event.listens_for(Session, "after_rollback")
+        def fail_commit(session):
+            current = session.info.pop("trace_commit_span", None)
+
+            if current is not None:
+                current.set_status(Status(StatusCode.ERROR, "commit rolled back"))
+                current.end()
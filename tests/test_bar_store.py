@@ -0,0 +1,86 @@
+import os
+
+import pandas as pd
+import pytest
+
+from bar_store import BarStore
+from data_source import DataSource
+
+
+class FakeSource(DataSource):
+    """Daily bars up to today, every history() call is recorded."""
+
+    def __init__(self, days=60):
+        index = pd.date_range(end=pd.Timestamp.now(tz="UTC").normalize(), periods=days, freq="D")
+        self.bars = pd.DataFrame({"Open": 1.0, "High": 2.0, "Low": 0.5, "Close": 1.5, "Volume": 100,
+                                  "Dividends": 0.0}, index=index)
+        self.calls = []
+
+    def history(self, symbol, interval, start=None, period=None):
+        self.calls.append({"symbol": symbol, "interval": interval, "start": start, "period": period})
+        return self.bars if start is None else self.bars[self.bars.index >= start]
+
+
+@pytest.fixture
+def source():
+    return FakeSource()
+
+
+def test_cold_fill_downloads_the_period_once(tmp_path, source):
+    store = BarStore(str(tmp_path), source, refresh_interval=3600)
+
+    bars = store.get("AAPL", "1d", "1mo")
+
+    assert len(source.calls) == 1
+    assert source.calls[0]["period"] is None
+    assert source.calls[0]["start"] == bars.index[0].normalize()
+    assert list(bars.columns) == ["Open", "High", "Low", "Close", "Volume"]
+    assert bars.index[-1] == source.bars.index[-1]
+    assert os.path.exists(tmp_path / "1d" / "AAPL.parquet")
+
+
+def test_no_upstream_call_within_the_refresh_interval(tmp_path, source):
+    store = BarStore(str(tmp_path), source, refresh_interval=3600)
+    first = store.get("AAPL", "1d", "1mo")
+
+    # A shorter period is inside the covered range too
+    assert store.get("AAPL", "1d", "1mo").equals(first)
+    assert len(store.get("AAPL", "1d", "5d")) < len(first)
+    assert len(source.calls) == 1
+
+
+def test_stale_range_only_fetches_from_the_last_stored_bar(tmp_path, source):
+    store = BarStore(str(tmp_path), source, refresh_interval=0)
+    store.get("AAPL", "1d", "1mo")
+    last_stored = source.bars.index[-1]
+
+    # The last bar was still forming, a new one came after it
+    source.bars.loc[last_stored, "Close"] = 9.0
+    source.bars.loc[last_stored + pd.Timedelta(days=1)] = [1.0, 2.0, 0.5, 3.0, 100, 0.0]
+
+    bars = store.get("AAPL", "1d", "1mo")
+
+    assert len(source.calls) == 2
+    assert source.calls[1]["start"] == last_stored
+    assert list(bars["Close"].iloc[-2:]) == [9.0, 3.0]
+    assert not bars.index.duplicated().any()
+
+
+def test_invalid_period(tmp_path, source):
+    store = BarStore(str(tmp_path), source, refresh_interval=3600)
+
+    with pytest.raises(ValueError, match="Invalid period"):
+        store.get("AAPL", "1d", "2w")
+
+    assert not source.calls
+
+
+@pytest.mark.parametrize("symbol", ["../AAPL", "..", "AAPL/../../x", "aapl"])
+def test_symbol_outside_the_pattern_is_rejected(tmp_path, source, symbol):
+    store = BarStore(str(tmp_path / "bars"), source, refresh_interval=3600)
+
+    with pytest.raises(ValueError, match="Invalid symbol"):
+        store.get(symbol, "1d", "1mo")
+
+    assert not source.calls
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,32 @@
+import asyncio
+
+from shared.cache import MemoryBackend, UserCache
+
+
+def test_generations_bounded_and_evicted_users_move_past_their_entries():
+    async def scenario():
+        backend = MemoryBackend(max_size=3)
+        cache = UserCache(backend, ttl=60)
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            return {"balance": len(loads)}
+
+        await cache.invalidate("a")
+        assert await cache.get("balance", "a", loader) == {"balance": 1}
+        assert await cache.get("balance", "a", loader) == {"balance": 1}
+
+        for username in "bcd":
+            await cache.invalidate(username)
+
+        # "a" had the oldest bump and was evicted, its generation comes from the floor now
+        assert len(backend.generations) == 3
+        assert "a" not in backend.generations
+        assert await backend.generation("a") >= backend.floor > 0
+
+        # A later write to "a" still moves it to a generation never used before
+        await cache.invalidate("a")
+        assert await cache.get("balance", "a", loader) == {"balance": 2}
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import threading
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import text
+
+import shared.events as events
+from matching_engine import MatchingEngine
+from shared.events import InProcessTransport, ORDER_EVENTS_CHANNEL, parse_order_events, publish_order_event
+from shared.schemas import OrderEvent
+
+SYMBOL = "TEST_EVENTS"
+
+
+@pytest.fixture
+def in_process(monkeypatch):
+    transport = InProcessTransport()
+    monkeypatch.setattr(events, "transport", transport)
+    return transport
+
+
+def test_wait_wakes_up_on_any_channel(in_process):
+    listener = in_process.listen("first", "second")
+    sender = threading.Timer(0.05, in_process.after_commit, [[("second", "hello")]])
+    sender.start()
+
+    try:
+        assert listener.wait(5) == [("second", "hello")]
+        assert listener.wait(0) == []
+    finally:
+        sender.cancel()
+        listener.close()
+
+
+def test_every_listener_gets_the_events_sent_after_it_started(in_process):
+    in_process.after_commit([("orders", "before")])
+    first, second = in_process.listen("orders"), in_process.listen("orders")
+
+    in_process.after_commit([("orders", "1"), ("other", "x"), ("orders", "2")])
+    second.close()
+    in_process.after_commit([("orders", "3")])
+
+    assert first.wait(0) == [("orders", "1"), ("orders", "2"), ("orders", "3")]
+    assert second.wait(0) == [("orders", "1"), ("orders", "2")]
+
+
+def place(db, order, username, quantity, price):
+    params = {"username": username, "symbol": SYMBOL, "quantity": quantity, "price": price, "flag": "unprocessed",
+              "created_at": datetime.now(timezone.utc), "cost": quantity * price}
+    trade_id = db.execute(order, params).scalar()
+
+    # What /add_trade does after the insert
+    publish_order_event(db, OrderEvent(action="add", trade_id=trade_id, symbol=SYMBOL))
+    db.commit()
+
+    return trade_id
+
+
+def test_order_placed_is_settled_from_its_event(in_process, db_session, db_interaction):
+    db = db_session
+    db.execute(text("INSERT INTO users (username, password, balance) VALUES ('events_buyer', 'x', 100), ('events_seller', 'x', 0)"))
+    db.execute(text("INSERT INTO portfolio (username, symbol, quantity, price) VALUES ('events_seller', :symbol, 5, 1)"),
+               {"symbol": SYMBOL})
+    db.commit()
+
+    # The matcher never does a full load here, it only knows the orders from their events
+    engine = MatchingEngine()
+    listener = in_process.listen(ORDER_EVENTS_CHANNEL)
+
+    try:
+        sell_id = place(db, db_interaction.SELL_ORDER, "events_seller", 5, 2)
+        buy_id = place(db, db_interaction.BUY_ORDER, "events_buyer", 5, 2)
+
+        engine.apply_events(db, parse_order_events(listener.wait(1)))
+        db.commit()
+
+        assert engine.match(db) == 1
+    finally:
+        listener.close()
+
+    flags = db.execute(text("SELECT id, flag FROM trades WHERE id IN (:sell_id, :buy_id) ORDER BY id"),
+                       {"sell_id": sell_id, "buy_id": buy_id}).all()
+    assert [tuple(row) for row in flags] == [(sell_id, "executed"), (buy_id, "executed")]
+    assert db.execute(text("SELECT quantity FROM portfolio WHERE username = 'events_buyer' AND symbol = :symbol"),
+                      {"symbol": SYMBOL}).scalar() == 5
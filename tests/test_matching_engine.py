@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from matching_engine import MatchingEngine
+
+SYMBOL = "TEST_MATCH"
+
+
+def place(db, username, action, quantity, price, created_at):
+    return db.execute(text("""
+        INSERT INTO trades (username, symbol, quantity, price, action, created_at, flag, portfolio_price)
+        VALUES (:username, :symbol, :quantity, :price, :action, :created_at, 'unprocessed', :portfolio_price)
+        RETURNING id
+    """), {"username": username, "symbol": SYMBOL, "quantity": quantity, "price": price, "action": action,
+           "created_at": created_at, "portfolio_price": 1 if action == "sell" else -1}).scalar()
+
+
+def test_book_reloaded_after_stale_settlement_is_matched_again(db_session):
+    db = db_session
+    db.execute(text("INSERT INTO users (username, password, balance) VALUES ('match_buyer', 'x', 0), ('match_seller', 'x', 0)"))
+    created_at = datetime.now(timezone.utc) - timedelta(minutes=1)
+    sell_id = place(db, "match_seller", "sell", 5, 10, created_at)
+    buy_id = place(db, "match_buyer", "buy", 5, 10, created_at + timedelta(seconds=1))
+    db.commit()
+
+    engine = MatchingEngine()
+    engine.load_symbol(db, SYMBOL)
+
+    # The seller edits the order after the book was loaded, the fill of 5 no longer fits
+    db.execute(text("UPDATE trades SET quantity = 3 WHERE id = :id"), {"id": sell_id})
+    db.commit()
+
+    assert engine.match(db) == 1
+    assert not engine.dirty
+
+    fills = db.execute(text("SELECT sell_trade_id, buy_trade_id, quantity FROM fills WHERE symbol = :symbol"),
+                       {"symbol": SYMBOL}).all()
+    assert [tuple(fill) for fill in fills] == [(sell_id, buy_id, 3)]
+    assert engine.books[SYMBOL].orders[buy_id].quantity == 2
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from matching_engine import MatchingEngine
+from order_book import Order, OrderBook
+
+CREATED_AT = datetime(2025, 1, 2, 15, 30, tzinfo=timezone.utc)
+
+
+def trade(id, action, price, quantity, created_at=CREATED_AT, username="b"):
+    return SimpleNamespace(id=id, username=username, symbol="AAPL", action=action, price=price,
+                           quantity=quantity, created_at=created_at, portfolio_price=1)
+
+
+def test_edit_only_quantity_of_resting_order():
+    engine = MatchingEngine()
+    engine.apply(trade(1, "sell", 10, 5))
+
+    # What /edit_trade produces: same id, price and created_at, new quantity
+    engine.apply(trade(1, "sell", 10, 3))
+
+    book = engine.books["AAPL"]
+    assert len(book) == 1
+    assert book.orders[1].quantity == 3
+
+    engine.apply(trade(2, "buy", 10, 5, created_at=CREATED_AT + timedelta(seconds=1), username="a"))
+    fills = book.match()
+
+    assert [(fill.buy.id, fill.sell.id, fill.quantity) for fill in fills] == [(2, 1, 3)]
+    assert book.orders[2].quantity == 2
+    assert 1 not in book.orders
+
+
+def test_edit_only_quantity_of_resting_bid():
+    engine = MatchingEngine()
+    engine.apply(trade(1, "buy", 10, 5, username="a"))
+    engine.apply(trade(1, "buy", 10, 7, username="a"))
+    engine.apply(trade(1, "buy", 10, 4, username="a"))
+
+    engine.apply(trade(2, "sell", 9, 10, created_at=CREATED_AT + timedelta(seconds=1)))
+    fills = engine.books["AAPL"].match()
+
+    assert [(fill.buy.id, fill.sell.id, fill.quantity) for fill in fills] == [(1, 2, 4)]
+
+
+def order(id, action, price, quantity, created_at=CREATED_AT):
+    return Order(id, "a" if action == "buy" else "b", "AAPL", action, price, quantity, created_at)
+
+
+def test_price_time_priority():
+    book = OrderBook("AAPL")
+    book.add(order(1, "sell", 11, 5))
+    book.add(order(2, "sell", 10, 5, created_at=CREATED_AT + timedelta(seconds=2)))
+    book.add(order(3, "sell", 10, 5, created_at=CREATED_AT + timedelta(seconds=1)))
+    book.add(order(4, "buy", 12, 12, created_at=CREATED_AT + timedelta(seconds=3)))
+
+    fills = book.match()
+
+    # Best price first, the older of the two at 10 before the newer one
+    assert [(fill.sell.id, fill.quantity, fill.price) for fill in fills] == [(3, 5, 10), (2, 5, 10), (1, 2, 11)]
+    assert book.orders[1].quantity == 3
+    assert 4 not in book.orders
+
+
+def test_best_bid_first_and_fill_at_sell_price():
+    book = OrderBook("AAPL")
+    book.add(order(1, "buy", 9, 5))
+    book.add(order(2, "buy", 11, 5, created_at=CREATED_AT + timedelta(seconds=1)))
+    book.add(order(3, "sell", 10, 5, created_at=CREATED_AT + timedelta(seconds=2)))
+
+    fills = book.match()
+
+    assert [(fill.buy.id, fill.sell.id, fill.price) for fill in fills] == [(2, 3, 10)]
+    assert 1 in book.orders
+
+
+def test_same_price_and_time_tie_broken_by_id():
+    book = OrderBook("AAPL")
+    book.add(order(7, "sell", 10, 5))
+    book.add(order(5, "sell", 10, 5))
+    book.add(order(6, "sell", 10, 5))
+    book.add(order(8, "buy", 10, 10, created_at=CREATED_AT + timedelta(seconds=1)))
+
+    fills = book.match()
+
+    assert [fill.sell.id for fill in fills] == [5, 6]
+    assert list(book.orders) == [7]
+
+
+def test_no_fill_when_prices_do_not_cross():
+    book = OrderBook("AAPL")
+    book.add(order(1, "sell", 10, 5))
+    book.add(order(2, "buy", 9, 5))
+
+    assert book.match() == []
+    assert len(book) == 2
@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import quote_cache
+from quote_cache import QuoteCache
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    # Only the cache's clock, the event loop keeps the real one
+    monkeypatch.setattr(quote_cache, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+class Upstream:
+    """Loader counting its calls, optionally held until released."""
+
+    def __init__(self, held=False):
+        self.calls = 0
+        self.released = threading.Event()
+
+        if not held:
+            self.released.set()
+
+    def __call__(self, key):
+        self.calls += 1
+        self.released.wait(5)
+        return f"{key}-{self.calls}"
+
+
+def test_fresh_within_ttl_then_reloaded_once_expired(clock):
+    async def scenario():
+        cache = QuoteCache("test", ttl=10, stale_ttl=5, max_size=10)
+        upstream = Upstream()
+
+        assert await cache.get("AAPL", upstream) == "AAPL-1"
+        clock.now += 9
+        assert await cache.get("AAPL", upstream) == "AAPL-1"
+        assert upstream.calls == 1
+
+        # Past ttl + stale_ttl the old value isn't served any more, the caller waits for the upstream
+        clock.now += 7
+        assert await cache.get("AAPL", upstream) == "AAPL-2"
+        assert upstream.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_misses_share_one_upstream_call(clock):
+    async def scenario():
+        cache = QuoteCache("test", ttl=10, stale_ttl=5, max_size=10)
+        upstream = Upstream(held=True)
+
+        waiters = [asyncio.create_task(cache.get("AAPL", upstream)) for _ in range(20)]
+        await asyncio.sleep(0.05)
+        upstream.released.set()
+
+        assert await asyncio.gather(*waiters) == ["AAPL-1"] * 20
+        assert upstream.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_stale_value_served_while_the_refresh_runs(clock):
+    async def scenario():
+        cache = QuoteCache("test", ttl=10, stale_ttl=5, max_size=10)
+        upstream = Upstream()
+        await cache.get("AAPL", upstream)
+
+        upstream.released.clear()
+        clock.now += 12
+
+        # Answered right away from the stale entry, the refresh is still held upstream
+        assert await asyncio.wait_for(cache.get("AAPL", upstream), 1) == "AAPL-1"
+        assert await cache.get("AAPL", upstream) == "AAPL-1"
+        refresh = cache.inflight["AAPL"]
+
+        upstream.released.set()
+        await refresh
+
+        assert await cache.get("AAPL", upstream) == "AAPL-2"
+        assert upstream.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_least_recently_used_entry_evicted(clock):
+    async def scenario():
+        cache = QuoteCache("test", ttl=10, stale_ttl=5, max_size=2)
+        upstream = Upstream()
+
+        await cache.get("AAPL", upstream)
+        await cache.get("MSFT", upstream)
+        await cache.get("AAPL", upstream)
+        await cache.get("GOOG", upstream)
+
+        assert list(cache.entries) == ["AAPL", "GOOG"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,66 @@
+import asyncio
+
+from quote_hub import QuoteHub, Subscription
+
+
+def test_updates_conflated_until_read():
+    async def scenario():
+        subscription = Subscription(["AAPL", "MSFT"])
+
+        for price in (1, 2, 3):
+            subscription.push("AAPL", {"price": price, "volume": 10})
+
+        subscription.push("MSFT", {"price": 5, "volume": 1})
+
+        assert await subscription.next(1) == {"AAPL": {"price": 3, "volume": 10}, "MSFT": {"price": 5, "volume": 1}}
+        assert await subscription.next(0.01) is None
+
+    asyncio.run(scenario())
+
+
+def test_only_changed_fields_sent():
+    async def scenario():
+        subscription = Subscription(["AAPL"])
+        subscription.push("AAPL", {"price": 1, "volume": 10})
+        await subscription.next(1)
+
+        subscription.push("AAPL", {"price": 2, "volume": 10})
+        assert await subscription.next(1) == {"AAPL": {"price": 2}}
+
+        # Same quote again, nothing to send
+        subscription.push("AAPL", {"price": 2, "volume": 10})
+        assert await subscription.next(1) == {}
+
+    asyncio.run(scenario())
+
+
+def test_one_poller_per_symbol_stopped_after_the_last_unsubscribe():
+    async def scenario():
+        polled = []
+
+        async def loader(symbol):
+            polled.append(symbol)
+            return {"price": len(polled)}
+
+        hub = QuoteHub(loader, interval=0.01)
+        first = hub.subscribe(["AAPL"])
+        second = hub.subscribe(["AAPL", "MSFT"])
+
+        assert set(hub.pollers) == {"AAPL", "MSFT"}
+        assert "AAPL" in await first.next(1)
+        poller = hub.pollers["AAPL"]
+
+        hub.unsubscribe(first)
+        assert hub.pollers["AAPL"] is poller
+
+        hub.unsubscribe(second)
+        await asyncio.sleep(0)
+
+        assert hub.pollers == {} and hub.subscribers == {}
+        assert poller.cancelled()
+
+        count = len(polled)
+        await asyncio.sleep(0.05)
+        assert len(polled) == count
+
+    asyncio.run(scenario())